@@ -24,7 +24,7 @@ CLASSIFIERS = [
 INSTALL_REQUIRES = [
     'argon2-cffi',
     'asn1crypto',
-    'censys',
+    'censys==0.0.8',  # ocspdash.util.RateLimitedCensysCertificates overrides its private _make_call
     'click',
     'cryptography',
     # 'flasgger',  # flasgger is temporarily disabled due to a security vulnerability
@@ -32,10 +32,7 @@ INSTALL_REQUIRES = [
     'flask-admin',
     'flask-bootstrap',
     'flask-sqlalchemy',
-    'jsonlines',
-    'ocspbuilder',
-    'oscrypto',
-    'passlib',
+    'orjson',
     'python-jose',
     'requests',
     'sqlalchemy',
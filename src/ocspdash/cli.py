@@ -48,6 +48,19 @@ def update(buckets, connection, verbose):
     m.update(n=buckets)
 
 
+@main.command()
+@click.option(
+    '--connection', help=f'SQLAlchemy connection. Defaults to {OCSPDASH_CONNECTION}'
+)
+@click.option('-v', '--verbose', is_flag=True, help='Verbose output')
+def upgrade(connection, verbose):
+    """Upgrade a database created by an earlier version."""
+    logging.basicConfig(level=(logging.DEBUG if verbose else logging.INFO))
+
+    m = Manager.from_args(connection=connection)
+    m.upgrade_database()
+
+
 @main.command()
 @click.option(
     '--connection', help=f'SQLAlchemy connection. Defaults to {OCSPDASH_CONNECTION}'
@@ -16,13 +16,18 @@ __all__ = [
     'OCSPDASH_DEFAULT_CONNECTION',
     'OCSPDASH_CONNECTION',
     'CENSYS_RATE_LIMIT',
+    'CENSYS_REPORT_CACHE_TTL',
+    'OCSPDASH_PAYLOAD_CACHE_TTL',
+    'OCSPDASH_MANIFEST_CACHE_TTL',
     'OCSPDASH_USER_AGENT_IDENTIFIER',
     'OCSPDASH_USER_AGENT',
     'OCSPSCRAPE_USER_AGENT_IDENTIFIER',
     'OCSPSCRAPE_USER_AGENT',
     'OCSPSCRAPE_PRIVATE_KEY_ALGORITHMS',
+    'OCSPSCRAPE_TIMEOUT',
+    'OCSPSCRAPE_OCSP_NONCE',
     'OCSP_RESULTS_JWT_CLAIM',
-    'OCSP_JWT_ALGORITHM',
+    'OCSP_JWT_ALGORITHMS',
 ]
 
 VERSION = '0.1.0-dev'
@@ -53,6 +58,20 @@ CENSYS_RATE_LIMIT = float(  # max requests per second
     os.environ.get('OCSPDASH_RATE', 0.2)
 )
 
+#: The number of seconds Censys reports are cached on disk for. Can be set from the environment variable
+#: ``OCSPDASH_CENSYS_REPORT_CACHE_TTL`` or defaults to ``86400`` (one day). Set to ``0`` to disable the cache.
+CENSYS_REPORT_CACHE_TTL = float(
+    os.environ.get('OCSPDASH_CENSYS_REPORT_CACHE_TTL', 86400)
+)
+
+#: The number of seconds the home page payload is cached for when no new results have been submitted. Can be set from
+#: the environment variable ``OCSPDASH_PAYLOAD_CACHE_TTL`` or defaults to ``60``.
+OCSPDASH_PAYLOAD_CACHE_TTL = float(os.environ.get('OCSPDASH_PAYLOAD_CACHE_TTL', 60))
+
+#: The number of seconds a manifest is served from the cache before it is rebuilt in the background. Can be set from
+#: the environment variable ``OCSPDASH_MANIFEST_CACHE_TTL`` or defaults to ``60``.
+OCSPDASH_MANIFEST_CACHE_TTL = float(os.environ.get('OCSPDASH_MANIFEST_CACHE_TTL', 60))
+
 OCSPDASH_USER_AGENT_IDENTIFIER = f'OCSPdash/{VERSION}'
 OCSPDASH_USER_AGENT = ' '.join(
     [requests.utils.default_user_agent(), OCSPDASH_USER_AGENT_IDENTIFIER]
@@ -63,7 +82,16 @@ OCSPSCRAPE_USER_AGENT = ' '.join(
     [requests.utils.default_user_agent(), OCSPSCRAPE_USER_AGENT_IDENTIFIER]
 )
 
-OCSPSCRAPE_PRIVATE_KEY_ALGORITHMS = [ec.SECP521R1]
+OCSPSCRAPE_PRIVATE_KEY_ALGORITHMS = (ec.SECP256R1, ec.SECP521R1)
+
+#: The timeout in seconds for each ping and OCSP request made by OCSPscrape. Can be set from the environment variable
+#: ``OCSPSCRAPE_TIMEOUT`` or defaults to ``5``.
+OCSPSCRAPE_TIMEOUT = float(os.environ.get('OCSPSCRAPE_TIMEOUT', 5))
+
+#: Whether OCSPscrape includes a nonce in its OCSP requests. Without a nonce, the request for a certificate is always
+#: the same and can be reused. Can be enabled by setting the environment variable ``OCSPSCRAPE_OCSP_NONCE`` to ``1``.
+OCSPSCRAPE_OCSP_NONCE = os.environ.get('OCSPSCRAPE_OCSP_NONCE') == '1'
 
 OCSP_RESULTS_JWT_CLAIM = os.environ.get('OCSPDASH_RESULTS_JWT_CLAIM', 'res')
-OCSP_JWT_ALGORITHM = os.environ.get('OCSPDASH_JWT_ALGORITHM', 'ES512')
+#: The JWT algorithm that tokens signed with a key on each accepted curve use, keyed by curve name
+OCSP_JWT_ALGORITHMS = {ec.SECP256R1.name: 'ES256', ec.SECP521R1.name: 'ES512'}
@@ -7,28 +7,66 @@ from __future__ import annotations
 import logging
 import os
 import secrets
+import threading
+import time
 import uuid
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from itertools import groupby
-from operator import attrgetter
-from typing import Iterable, List, Mapping, Optional, Tuple
+from datetime import datetime, timedelta
+from typing import (
+    DefaultDict,
+    Deque,
+    Dict,
+    Iterable,
+    List,
+    Mapping,
+    Optional,
+    Set,
+    Tuple,
+)
 
-from sqlalchemy import and_, create_engine, func
+import orjson
+from sqlalchemy import DateTime, and_, bindparam, create_engine, func, inspect, text
 from sqlalchemy.engine import Engine
-from sqlalchemy.orm import scoped_session, sessionmaker
+from sqlalchemy.orm import (
+    contains_eager,
+    defer,
+    joinedload,
+    scoped_session,
+    sessionmaker,
+)
 
 from ocspdash.constants import (
     OCSPDASH_DEFAULT_CONNECTION,
+    OCSPDASH_MANIFEST_CACHE_TTL,
+    OCSPDASH_PAYLOAD_CACHE_TTL,
     OCSPDASH_USER_AGENT_IDENTIFIER,
 )
-from ocspdash.models import Authority, Base, Chain, Location, Responder, Result
-from ocspdash.security import pwd_context
+from ocspdash.models import (
+    Authority,
+    Base,
+    Chain,
+    Location,
+    Responder,
+    Result,
+    get_certificate_not_after,
+)
+from ocspdash.security import hash_validator
 from ocspdash.server_query import ServerQuery
 
 __all__ = ['Manager']
 
 logger = logging.getLogger(__name__)
 
+#: The number of attempts to process an invite allowed for each selector prefix within :data:`INVITE_ATTEMPT_WINDOW`
+INVITE_ATTEMPT_LIMIT = 5
+#: The sliding window, in seconds, over which attempts to process an invite are counted
+INVITE_ATTEMPT_WINDOW = 60
+
+#: The number of threads used to retrieve new chains concurrently
+CHAIN_RETRIEVAL_WORKERS = 8
+
 
 def _workaround_pysqlite_transaction_bug():
     """Work around pysqlite transaction bug.
@@ -70,6 +108,8 @@ _workaround_pysqlite_transaction_bug()
 class Payload:
     """A payload to be parsed by the index.html template."""
 
+    __slots__ = ('authorities', 'locations')
+
     authorities: List[AuthorityPayload]  # noqa: F821
     locations: List[Location]
 
@@ -78,16 +118,23 @@ class Payload:
 class AuthorityPayload:
     """The authority section of the payload for the index.html template."""
 
+    __slots__ = ('authority', 'responders')
+
     authority: Authority
     responders: List[ResponderPayload]  # noqa: F821
 
 
 @dataclass
 class ResponderPayload:
-    """The responder section of the payload for the index.html template."""
+    """The responder section of the payload for the index.html template.
+
+    The results line up with the locations of the Payload, with None where a location has no result.
+    """
+
+    __slots__ = ('responder', 'results')
 
     responder: Responder
-    results: Iterable[Result]
+    results: List[Optional[Result]]
 
 
 class Manager:
@@ -109,6 +156,22 @@ class Manager:
         self.session = session
         self.server_query = server_query
 
+        #: The most recent Payload, with the results version it was built from and when it was built
+        self._payload_cache: Optional[Tuple[Tuple[int, int], float, Payload]] = None
+
+        #: The most recent manifest for each number of authorities, with when it was built
+        self._manifest_cache: Dict[Optional[int], Tuple[float, bytes]] = {}
+        #: The numbers of authorities whose manifests are being rebuilt in the background
+        self._manifest_refreshes: Set[Optional[int]] = set()
+        self._manifest_lock = threading.Lock()
+        self._manifest_refresher = ThreadPoolExecutor(max_workers=1)
+
+        #: The id of the newest chain whose issuer certificate has been given to the ServerQuery
+        self._issuer_certs_added_through_chain_id = 0
+
+        #: The times of recent attempts to process an invite, keyed by selector prefix
+        self._invite_attempts: DefaultDict[bytes, Deque[float]] = defaultdict(deque)
+
         self.create_all()
 
     @classmethod
@@ -201,6 +264,49 @@ class Manager:
         """
         Base.metadata.create_all(self.engine, checkfirst=checkfirst)
 
+    def upgrade_database(self):
+        """Bring a database created by an earlier version of OCSPdash up to date with the models.
+
+        :meth:`create_all` only creates missing tables, so this adds the ``chain.not_after`` column, fills it in from
+        the stored subject certificates, and creates any missing indexes. It is safe to run more than once.
+        """
+        inspector = inspect(self.engine)
+        chain_table = Chain.__table__
+
+        chain_columns = {
+            column['name'] for column in inspector.get_columns(chain_table.name)
+        }
+        if 'not_after' not in chain_columns:
+            logger.info('adding column %s.not_after', chain_table.name)
+            not_after_type = chain_table.c.not_after.type.compile(
+                dialect=self.engine.dialect
+            )
+            self.engine.execute(
+                f'ALTER TABLE {chain_table.name} ADD COLUMN not_after {not_after_type}'
+            )
+
+        for table in Base.metadata.sorted_tables:
+            index_names = {index['name'] for index in inspector.get_indexes(table.name)}
+            for index in table.indexes:
+                if index.name not in index_names:
+                    logger.info('creating index %s', index.name)
+                    index.create(self.engine)
+
+        not_afters = [
+            {'id': chain_id, 'not_after': get_certificate_not_after(subject)}
+            for chain_id, subject in self.session.query(Chain.id, Chain.subject).filter(
+                Chain.not_after.is_(None)
+            )
+        ]
+        logger.info('filling in not_after for %d chains', len(not_afters))
+        if not_afters:
+            # a plain UPDATE, since the ORM would also run the onupdate default of certificate_chain_uuid
+            update_not_after = text(
+                f'UPDATE {chain_table.name} SET not_after = :not_after WHERE id = :id'
+            ).bindparams(bindparam('not_after', type_=DateTime))
+            self.session.execute(update_not_after, not_afters)
+        self.session.commit()
+
     def drop_database(self):
         """Drop all tables from the connected database."""
         Base.metadata.drop_all(self.engine)
@@ -239,18 +345,38 @@ class Manager:
 
         :returns: the new or updated Authority
         """
-        authority = self.get_authority_by_name(name)
+        return self.ensure_authorities({name: cardinality})[0]
 
-        if authority is None:
-            authority = Authority(name=name, cardinality=cardinality)
-            self.session.add(authority)
+    def ensure_authorities(self, cardinalities: Mapping[str, int]) -> List[Authority]:
+        """Create or update several Authorities in the DB with one query and one commit.
 
-        else:
-            authority.cardinality = cardinality
+        :param cardinalities: a mapping from the name of each authority to its cardinality
+
+        :returns: the new or updated Authorities, in the order of the mapping
+        """
+        existing_authorities = {
+            authority.name: authority
+            for authority in self.session.query(Authority).filter(
+                Authority.name.in_(list(cardinalities))
+            )
+        }
+
+        authorities = []
+        for name, cardinality in cardinalities.items():
+            authority = existing_authorities.get(name)
+
+            if authority is None:
+                authority = Authority(name=name, cardinality=cardinality)
+                self.session.add(authority)
+
+            else:
+                authority.cardinality = cardinality
+
+            authorities.append(authority)
 
         self.session.commit()
 
-        return authority
+        return authorities
 
     def get_responder(self, authority: Authority, url: str) -> Optional[Responder]:
         """Get a responder by the authority and URL.
@@ -277,18 +403,45 @@ class Manager:
 
         :returns: the new or updated Responder
         """
-        responder = self.get_responder(authority=authority, url=url)
+        return self.ensure_responders(authority, {url: cardinality})[0]
 
-        if responder is None:
-            responder = Responder(authority=authority, url=url, cardinality=cardinality)
-            self.session.add(responder)
+    def ensure_responders(
+        self, authority: Authority, cardinalities: Mapping[str, int]
+    ) -> List[Responder]:
+        """Create or update several responders for an Authority in the DB with one query and one commit.
 
-        else:
-            responder.cardinality = cardinality
+        :param authority: the corresponding Authority for the responders
+        :param cardinalities: a mapping from the URL of each responder to its cardinality
+
+        :returns: the new or updated Responders, in the order of the mapping
+        """
+        f = and_(
+            Responder.authority_id == authority.id,
+            Responder.url.in_(list(cardinalities)),
+        )
+        existing_responders = {
+            responder.url: responder
+            for responder in self.session.query(Responder).filter(f)
+        }
+
+        responders = []
+        for url, cardinality in cardinalities.items():
+            responder = existing_responders.get(url)
+
+            if responder is None:
+                responder = Responder(
+                    authority=authority, url=url, cardinality=cardinality
+                )
+                self.session.add(responder)
+
+            else:
+                responder.cardinality = cardinality
+
+            responders.append(responder)
 
         self.session.commit()
 
-        return responder
+        return responders
 
     def get_chain_by_certificate_chain_uuid(
         self, certificate_chain_uuid: uuid.UUID
@@ -305,6 +458,25 @@ class Manager:
             .one_or_none()
         )
 
+    def get_chain_ids_by_certificate_chain_uuids(
+        self, certificate_chain_uuids: Iterable[uuid.UUID]
+    ) -> Dict[uuid.UUID, int]:
+        """Get the ids of the chains with any of several certificate chain UUIDs in one query.
+
+        :param certificate_chain_uuids: the certificate chain UUIDs
+
+        :returns: a dictionary from certificate chain UUID to chain id, without the UUIDs that match no chain
+        """
+        certificate_chain_uuids = set(certificate_chain_uuids)
+        if not certificate_chain_uuids:
+            return {}
+
+        return dict(
+            self.session.query(Chain.certificate_chain_uuid, Chain.id).filter(
+                Chain.certificate_chain_uuid.in_(certificate_chain_uuids)
+            )
+        )
+
     def get_most_recent_chain_by_responder(
         self, responder: Responder
     ) -> Optional[Chain]:
@@ -335,31 +507,72 @@ class Manager:
 
         :returns: the Chain or None
         """
+        return self.ensure_chains([responder])[0]
+
+    def ensure_chains(self, responders: Iterable[Responder]) -> List[Optional[Chain]]:
+        """Get or create chains for several Responders.
+
+        Follows the same rules as :meth:`ensure_chain`. New chains are retrieved from Censys concurrently, then added
+        to the database with one commit.
+
+        :param responders: the Responders whose chains we're seeking
+
+        :returns: the Chain or None for each Responder, in order
+        """
         if self.server_query is None:
             raise RuntimeError('Missing sensys server query')
 
-        most_recent_chain = self.get_most_recent_chain_by_responder(responder)
+        chains: List[Optional[Chain]] = []
+        responders_needing_chains = []
 
-        if most_recent_chain and not most_recent_chain.old:
-            if not most_recent_chain.expired:
-                return most_recent_chain
-
-            if not responder.current:
-                return most_recent_chain
+        for responder in responders:
+            most_recent_chain = (
+                self.session.query(Chain)
+                .filter(Chain.responder_id == responder.id, ~Chain.old)
+                .options(defer(Chain.subject), defer(Chain.issuer))
+                .order_by(Chain.retrieved.desc())
+                .first()
+            )
 
-        subject, issuer = self.server_query.get_certs_for_issuer_and_url(
-            responder.authority.name, responder.url
-        )
+            if most_recent_chain:
+                if not most_recent_chain.expired or not responder.current:
+                    chains.append(most_recent_chain)
+                    continue
+
+            chains.append(None)
+            responders_needing_chains.append((len(chains) - 1, responder))
+
+        if not responders_needing_chains:
+            return chains
+
+        self._add_known_issuer_certs()
+
+        # only the thread-safe ServerQuery is used from the pool; the session stays on this thread
+        issuers_and_urls = [
+            (responder.authority.name, responder.url)
+            for _, responder in responders_needing_chains
+        ]
+        with ThreadPoolExecutor(max_workers=CHAIN_RETRIEVAL_WORKERS) as executor:
+            retrieved_certs = list(
+                executor.map(
+                    self.server_query.get_certs_for_issuer_and_url,
+                    *zip(*issuers_and_urls),
+                )
+            )
 
-        if subject is None or issuer is None:
-            return None
+        for (i, responder), (subject, issuer) in zip(
+            responders_needing_chains, retrieved_certs
+        ):
+            if subject is None or issuer is None:
+                continue
 
-        chain = Chain(responder=responder, subject=subject, issuer=issuer)
+            chain = Chain(responder=responder, subject=subject, issuer=issuer)
+            self.session.add(chain)
+            chains[i] = chain
 
-        self.session.add(chain)
         self.session.commit()
 
-        return chain
+        return chains
 
     def get_location_by_name(self, name: str) -> Optional[Location]:
         """Get a Location from the database by its name.
@@ -370,6 +583,27 @@ class Manager:
         """
         return self.session.query(Location).filter(Location.name == name).one_or_none()
 
+    def _add_known_issuer_certs(self):
+        """Give the ServerQuery the issuer certificates of the chains in the database.
+
+        Issuers of chains already in the database often issued the new subject certificates too. Only the chains added
+        since the last call are read, so repeated updates don't load and parse every issuer again.
+        """
+        max_chain_id = self.session.query(func.max(Chain.id)).scalar() or 0
+        if max_chain_id <= self._issuer_certs_added_through_chain_id:
+            return
+
+        new_issuers = (
+            self.session.query(Chain.issuer)
+            .filter(
+                Chain.id > self._issuer_certs_added_through_chain_id,
+                Chain.id <= max_chain_id,
+            )
+            .distinct()
+        )
+        self.server_query.add_issuer_certs(issuer for issuer, in new_issuers)
+        self._issuer_certs_added_through_chain_id = max_chain_id
+
     def update(self, n: int = 10):
         """Update the database of Authorities, Responders, and Chains from Censys.
 
@@ -390,30 +624,48 @@ class Manager:
         if self.server_query is None:
             raise RuntimeError('No username and password for Censys supplied')
 
-        authorities = self.get_top_authorities(n)
-        if not authorities or any(  # probably a first run with a clean DB
-            authority.old for authority in authorities
-        ):
+        if self._top_authorities_need_update(n):
             issuers = self.server_query.get_top_authorities(buckets=n)
-            for issuer_name, issuer_cardinality in issuers.items():
-                authority = self.ensure_authority(issuer_name, issuer_cardinality)
-
+            responders = []
+            for authority in self.ensure_authorities(issuers):
                 ocsp_urls = self.server_query.get_ocsp_urls_for_issuer(authority.name)
+                responders.extend(self.ensure_responders(authority, ocsp_urls))
 
-                for url, responder_cardinality in ocsp_urls.items():
-                    responder = self.ensure_responder(
-                        authority, url, responder_cardinality
-                    )
-                    self.ensure_chain(responder)
+            self.ensure_chains(responders)
 
         authorities = self.get_top_authorities(n)
         for authority in authorities:
             if any(responder.old for responder in authority.responders):
                 ocsp_urls = self.server_query.get_ocsp_urls_for_issuer(authority.name)
-                for url, responder_cardinality in ocsp_urls.items():
-                    self.ensure_responder(authority, url, responder_cardinality)
-            for responder in authority.responders:
-                self.ensure_chain(responder)
+                self.ensure_responders(authority, ocsp_urls)
+
+        self.ensure_chains(
+            [
+                responder
+                for authority in authorities
+                for responder in authority.responders
+            ]
+        )
+
+    def _top_authorities_need_update(self, n: int = 10) -> bool:
+        """Check in the database if there are no Authorities or if any of the top n Authorities are "old".
+
+        :param n: the number of top authorities to check
+        """
+        top_authorities = (
+            self.session.query(Authority.last_updated.label('last_updated'))
+            .order_by(Authority.cardinality.desc())
+            .limit(n)
+            .subquery('top_authorities')
+        )
+        count, least_recently_updated = self.session.query(
+            func.count(), func.min(top_authorities.c.last_updated)
+        ).one()
+
+        if not count:  # probably a first run with a clean DB
+            return True
+
+        return least_recently_updated < datetime.utcnow() - timedelta(days=7)
 
     def get_top_authorities(self, n: int = 10) -> List[Authority]:
         """Retrieve the top authorities (as measured by cardinality) from the database.
@@ -431,47 +683,47 @@ class Manager:
             .all()
         )
 
-    def get_most_recent_result_for_each_location(self) -> List[Result]:
+    def get_most_recent_result_for_each_location(self) -> Iterable[Result]:
         """Get the most recent result from each location for each authority.
 
+        The most recent result is found with a window function, so ties in the time retrieved yield only one result.
         Results are sorted by Authority cardinality, Authority name, Responder cardinality, Responder url, and Location name.
+        Each Result's Chain, Responder, Authority, and Location are loaded by the same query.
+        They are streamed from the database in batches rather than loaded all at once.
         """
-        timestamps_for_most_recent_results = (
+        ranked_results = (
             self.session.query(
-                Responder.id.label('resp_id'),
-                Location.id.label('loc_id'),
-                func.max(Result.retrieved).label('most_recent'),
+                Result.id.label('result_id'),
+                func.row_number()
+                .over(
+                    partition_by=(Chain.responder_id, Result.location_id),
+                    order_by=(Result.retrieved.desc(), Result.id.desc()),
+                )
+                .label('rank'),
             )
-            .select_from(Result)
-            .join(Chain)
-            .join(Responder)
-            .join(Location)
-            .group_by(Responder.id, Location.id)
-            .subquery()
+            .join(Result.chain)
+            .subquery('ranked_results')
         )
         query = (
             self.session.query(Result)
-            .select_from(timestamps_for_most_recent_results)
             .join(
-                Result,
-                Result.retrieved == timestamps_for_most_recent_results.c.most_recent,
-            )
-            .join(Chain)
-            .join(
-                Responder,
+                ranked_results,
                 and_(
-                    Responder.id == Chain.responder_id,
-                    Responder.id == timestamps_for_most_recent_results.c.resp_id,
+                    Result.id == ranked_results.c.result_id,
+                    ranked_results.c.rank == 1,
                 ),
             )
-            .join(
-                Location,
-                and_(
-                    Location.id == Result.location_id,
-                    Location.id == timestamps_for_most_recent_results.c.loc_id,
-                ),
+            .join(Result.chain)
+            .join(Chain.responder)
+            .join(Responder.authority)
+            .join(Result.location)
+            .options(
+                contains_eager(Result.chain).defer(Chain.subject).defer(Chain.issuer),
+                contains_eager(Result.chain)
+                .contains_eager(Chain.responder)
+                .contains_eager(Responder.authority),
+                contains_eager(Result.location),
             )
-            .join(Authority)
             .order_by(
                 Authority.cardinality.desc(),
                 Authority.name,
@@ -480,52 +732,91 @@ class Manager:
                 Location.name,
             )
         )
-        return query.all()
+        return query.execution_options(stream_results=True).yield_per(1000)
 
     def get_all_locations_with_test_results(self) -> List[Location]:
         """Return all the Location objects that have at least one associated Result.
 
         Locations are returned sorted by name.
         """
+        has_results = (
+            self.session.query(Result.id)
+            .filter(Result.location_id == Location.id)
+            .exists()
+        )
         return (
             self.session.query(Location)
-            .join(Location.results)
-            .group_by(Location.id)
-            .having(func.count(Result.location_id) > 0)
+            .filter(has_results)
             .order_by(Location.name)
             .all()
         )
 
+    def _get_results_version(self) -> Tuple[int, int]:
+        """Get a cheap summary of the Result table that changes whenever results are added or removed."""
+        max_id, count = self.session.query(
+            func.max(Result.id), func.count(Result.id)
+        ).one()
+        return max_id or 0, count
+
     def get_payload(self) -> Payload:
         """Get the current status payload for the home page.
 
+        The payload is cached until new results are submitted or for :data:`OCSPDASH_PAYLOAD_CACHE_TTL` seconds,
+        whichever comes first.
+
         :returns: a Payload suitable for parsing by the index.html template
         """
+        results_version = self._get_results_version()
+
+        if self._payload_cache is not None:
+            cached_version, cached_at, cached_payload = self._payload_cache
+            if (
+                cached_version == results_version
+                and time.monotonic() - cached_at < OCSPDASH_PAYLOAD_CACHE_TTL
+            ):
+                return cached_payload
+
+        payload = self._make_payload()
+        self._payload_cache = results_version, time.monotonic(), payload
+        return payload
+
+    def _make_payload(self) -> Payload:
+        """Build the current status payload for the home page from the database."""
         locations = self.get_all_locations_with_test_results()
+        location_indexes = {location.id: i for i, location in enumerate(locations)}
 
-        authorities = []
+        authority_payloads: Dict[Authority, AuthorityPayload] = {}
+        responder_payloads: Dict[Responder, ResponderPayload] = {}
 
-        for authority, results_by_authority in groupby(
-            self.get_most_recent_result_for_each_location(),
-            attrgetter('chain.responder.authority'),
-        ):
-            responders = []
+        for result in self.get_most_recent_result_for_each_location():
+            location_index = location_indexes.get(result.location_id)
+            if location_index is None:
+                # the location's first result was committed after the locations were queried
+                continue
 
-            for responder, results_by_authority_and_responder in groupby(
-                results_by_authority, attrgetter('chain.responder')
-            ):
-                responders.append(
-                    ResponderPayload(
-                        responder=responder,
-                        results=tuple(results_by_authority_and_responder),
+            responder = result.chain.responder
+
+            if responder not in responder_payloads:
+                responder_payloads[responder] = ResponderPayload(
+                    responder=responder, results=[None] * len(locations)
+                )
+
+                authority = responder.authority
+                if authority not in authority_payloads:
+                    authority_payloads[authority] = AuthorityPayload(
+                        authority=authority, responders=[]
                     )
+
+                authority_payloads[authority].responders.append(
+                    responder_payloads[responder]
                 )
 
-            authorities.append(
-                AuthorityPayload(authority=authority, responders=responders)
-            )
+            results = responder_payloads[responder].results
+            results[location_index] = result
 
-        return Payload(authorities=authorities, locations=locations)
+        return Payload(
+            authorities=list(authority_payloads.values()), locations=locations
+        )
 
     def get_location_by_key_id(self, key_id: uuid.UUID) -> Optional[Location]:
         """Get a location by its key id."""
@@ -542,7 +833,7 @@ class Manager:
         """
         selector = secrets.token_bytes(16)
         validator = secrets.token_bytes(16)
-        invite_validator_hash = pwd_context.hash(validator)
+        invite_validator_hash = hash_validator(validator)
 
         new_location = Location(
             name=location_name, selector=selector, validator_hash=invite_validator_hash
@@ -575,9 +866,16 @@ class Manager:
         selector = invite_token[:16]
         validator = invite_token[16:]
 
+        if not any(selector):  # no invite has an all-zero selector
+            return None
+
+        if self._invite_attempts_exceeded(selector):
+            logger.warning('too many attempts to process invites like %s', selector)
+            return None
+
         location = self.get_location_by_selector(selector)
         if location is None:
-            raise Exception(f'location not found for selector: {selector}')
+            return None
         if location.pubkey:  # this invite has already been used
             return None
         if not location.verify(validator):
@@ -588,6 +886,24 @@ class Manager:
         self.session.commit()
         return location
 
+    def _invite_attempts_exceeded(self, selector: bytes) -> bool:
+        """Record an attempt to process an invite and check if too many have been made recently.
+
+        Attempts are counted by the first two bytes of the selector, which bounds the memory used to track them.
+
+        :param selector: The selector of the invite being processed
+
+        :returns: True if more than :data:`INVITE_ATTEMPT_LIMIT` attempts were made in the window, False otherwise
+        """
+        now = time.monotonic()
+        attempts = self._invite_attempts[selector[:2]]
+
+        while attempts and now - attempts[0] > INVITE_ATTEMPT_WINDOW:
+            attempts.popleft()
+
+        attempts.append(now)
+        return len(attempts) > INVITE_ATTEMPT_LIMIT
+
     def get_most_recent_chains_for_authorities(
         self, n: Optional[int] = 10
     ) -> List[Chain]:
@@ -632,15 +948,74 @@ class Manager:
                     Chain.retrieved == most_recent_chain_timestamps.c.most_recent,
                 ),
             )
+            .options(joinedload(Chain.responder))
         )
 
         return query.all()
 
+    def get_manifest(self, n: Optional[int] = 10) -> bytes:
+        """Get the manifest of queries an OCSPscrape client should make, as JSON Lines.
+
+        A manifest is served from the cache for :data:`OCSPDASH_MANIFEST_CACHE_TTL` seconds. After that the stale
+        manifest is still served while a fresh one is built in the background, and it is kept if the rebuild fails.
+
+        :param n: The number of Authorities to include. Pass None for no limit.
+        """
+        with self._manifest_lock:
+            cached = self._manifest_cache.get(n)
+            if cached is not None:
+                cached_at, manifest = cached
+                if (
+                    time.monotonic() - cached_at >= OCSPDASH_MANIFEST_CACHE_TTL
+                    and n not in self._manifest_refreshes
+                ):
+                    self._manifest_refreshes.add(n)
+                    self._manifest_refresher.submit(self._refresh_manifest, n)
+                return manifest
+
+        manifest = self._make_manifest(n)
+        with self._manifest_lock:
+            self._manifest_cache[n] = time.monotonic(), manifest
+        return manifest
+
+    def _refresh_manifest(self, n: Optional[int]) -> None:
+        """Rebuild a cached manifest in a background thread, keeping the stale one if that fails."""
+        try:
+            manifest = self._make_manifest(n)
+        except Exception:
+            logger.exception('failed to rebuild the manifest for n=%s', n)
+        else:
+            with self._manifest_lock:
+                self._manifest_cache[n] = time.monotonic(), manifest
+        finally:
+            with self._manifest_lock:
+                self._manifest_refreshes.discard(n)
+            self.session.remove()  # the session belongs to this background thread
+
+    def _make_manifest(self, n: Optional[int]) -> bytes:
+        """Build the manifest for the top n authorities from the database."""
+        manifest = bytearray()
+        for chain in self.get_most_recent_chains_for_authorities(n):
+            manifest += orjson.dumps(
+                chain.get_manifest_json(),
+                option=orjson.OPT_SORT_KEYS | orjson.OPT_APPEND_NEWLINE,
+            )
+        return bytes(manifest)
+
     def insert_payload(self, location: Location, results: Iterable[Mapping]):
-        """Take the submitted payload and insert its results into the database."""
-        for prepared_result_dict in results:
-            result = Result(**prepared_result_dict)
-            result.location = location
-            self.session.add(result)
+        """Take the submitted payload and insert its results into the database.
+
+        The results are inserted with a single bulk INSERT rather than through the ORM.
+
+        :param location: The Location that submitted the results
+        :param results: Mappings of Result column names to values, excluding the location
+        """
+        rows = [
+            dict(prepared_result_dict, location_id=location.id)
+            for prepared_result_dict in results
+        ]
+
+        if rows:
+            self.session.execute(Result.__table__.insert(), rows)
 
         self.session.commit()
@@ -9,22 +9,26 @@ from datetime import datetime, timedelta, timezone
 from enum import Enum
 from typing import Mapping, Optional  # noqa: F401 imported for PyCharm type checking
 
+from asn1crypto import x509
 from cryptography.hazmat.backends import default_backend
 from cryptography.hazmat.primitives import serialization
-from oscrypto import asymmetric
 from sqlalchemy import (
     Boolean,
     Column,
     DateTime,
     ForeignKey,
+    Index,
     Integer,
     LargeBinary,
     String,
     Text,
     UniqueConstraint,
+    and_,
+    exists,
 )
 from sqlalchemy.ext.declarative import DeclarativeMeta, declarative_base
-from sqlalchemy.orm import backref, relationship
+from sqlalchemy.ext.hybrid import hybrid_property
+from sqlalchemy.orm import backref, column_property, relationship
 from sqlalchemy.sql import functions as func
 
 import ocspdash.util
@@ -34,7 +38,7 @@ from ocspdash.constants import (
     OCSPSCRAPE_PRIVATE_KEY_ALGORITHMS,
 )
 from ocspdash.custom_columns import UUID
-from ocspdash.security import pwd_context
+from ocspdash.security import verify_validator
 
 Base: DeclarativeMeta = declarative_base()
 
@@ -67,9 +71,9 @@ class Authority(Base):
 
     last_updated = Column(DateTime, server_default=func.now(), onupdate=func.now())
 
-    @property
+    @hybrid_property
     def old(self) -> bool:
-        """Return True if the last_updated time is older than 7 days, False otherwise."""
+        """Return True if the last_updated time is older than 7 days, False otherwise. Also usable in queries."""
         return self.last_updated < datetime.utcnow() - timedelta(days=7)
 
     def __repr__(self):
@@ -120,11 +124,6 @@ class Responder(Base):
     def __repr__(self):
         return f'{self.authority} at {self.url}'
 
-    @property
-    def current(self) -> bool:
-        """Calculate if this responder is current by the status of its most recent result over all chains."""
-        return not all(chain.expired for chain in self.chains)
-
     @property
     def most_recent_chain(self) -> 'Optional[Chain]':
         """Get the most recent chain for this Responder."""
@@ -133,9 +132,9 @@ class Responder(Base):
         except ValueError:
             return None
 
-    @property
+    @hybrid_property
     def old(self) -> bool:
-        """Return True if the last_updated time is older than 7 days, False otherwise."""
+        """Return True if the last_updated time is older than 7 days, False otherwise. Also usable in queries."""
         return self.last_updated < datetime.utcnow() - timedelta(days=7)
 
     def to_json(self):
@@ -158,9 +157,28 @@ def _certificate_uuid_default(context) -> uuid.UUID:
     subject = parameters['subject']
     issuer = parameters['issuer']
 
-    return ocspdash.util.uuid5(
-        NAMESPACE_OCSPDASH_CERTIFICATE_CHAIN_ID, subject + issuer
-    )
+    return ocspdash.util.uuid5(NAMESPACE_OCSPDASH_CERTIFICATE_CHAIN_ID, subject, issuer)
+
+
+def get_certificate_not_after(certificate: bytes) -> Optional[datetime]:
+    """Get when a DER-encoded certificate expires, as a naive UTC datetime.
+
+    :param certificate: The bytes of the certificate
+
+    :returns: The expiry, or None if the bytes are not a certificate
+    """
+    try:
+        validity = x509.Certificate.load(certificate)['tbs_certificate']['validity']
+        not_after = validity['not_after'].native
+    except (TypeError, ValueError):
+        return None
+
+    return not_after.astimezone(timezone.utc).replace(tzinfo=None)
+
+
+def _certificate_not_after_default(context) -> Optional[datetime]:
+    parameters = context.get_current_parameters()
+    return get_certificate_not_after(parameters['subject'])
 
 
 class Chain(Base):
@@ -194,16 +212,25 @@ class Chain(Base):
         doc='',
     )
 
+    not_after = Column(
+        DateTime,
+        default=_certificate_not_after_default,
+        index=True,
+        doc='when the subject certificate expires, or null if it could not be parsed',
+    )
+
+    __table_args__ = (
+        Index('ix_chain_responder_id_retrieved', responder_id, retrieved),
+    )
+
     @property
     def expired(self) -> bool:
-        """Return True if the subject certificate has expired, False otherwise."""
-        certificate = asymmetric.load_certificate(self.subject)
-        expires_on = certificate.asn1['tbs_certificate']['validity']['not_after'].native
-        return expires_on < datetime.utcnow().replace(tzinfo=timezone.utc)
+        """Return True if the subject certificate has expired or its expiry is unknown, False otherwise."""
+        return self.not_after is None or self.not_after < datetime.utcnow()
 
-    @property
+    @hybrid_property
     def old(self) -> bool:
-        """Return True if the last_updated time is older than 7 days, False otherwise."""
+        """Return True if the retrieved time is older than 7 days, False otherwise. Also usable in queries."""
         return self.retrieved < datetime.utcnow() - timedelta(days=7)
 
     def get_manifest_json(self) -> Mapping:
@@ -228,6 +255,14 @@ class Chain(Base):
         }
 
 
+Responder.current = column_property(
+    exists()
+    .where(and_(Chain.responder_id == Responder.id, Chain.not_after > func.now()))
+    .correlate_except(Chain),
+    doc='True if any of the chains for this responder contains an unexpired certificate',
+)
+
+
 class Location(Base):
     """An invite for a new testing location."""
 
@@ -254,7 +289,7 @@ class Location(Base):
 
         :returns: True if the validator is valid, False otherwise.
         """
-        return pwd_context.verify(validator, self.validator_hash)
+        return verify_validator(validator, self.validator_hash)
 
     def set_public_key(self, public_key: str):
         """Set the pubkey and key_id for the Location based on an input public key.
@@ -263,12 +298,10 @@ class Location(Base):
         """
         pubkey = b64decode(public_key)
         loaded_pubkey = serialization.load_pem_public_key(pubkey, default_backend())
-        if not any(
-            isinstance(getattr(loaded_pubkey, 'curve', None), algorithm)
-            for algorithm in OCSPSCRAPE_PRIVATE_KEY_ALGORITHMS
-        ):
+        curve = getattr(loaded_pubkey, 'curve', None)
+        if not isinstance(curve, OCSPSCRAPE_PRIVATE_KEY_ALGORITHMS):
             raise ValueError('Key type not in accepted algorithms')
-        self.pubkey = b64decode(public_key)
+        self.pubkey = pubkey
         self.key_id = uuid.uuid5(NAMESPACE_OCSPDASH_KID, public_key)
 
     @property
@@ -294,7 +327,9 @@ class Location(Base):
             'validator_hash': self.validator_hash,
             'pubkey': str(self.pubkey),
             'key_id': str(self.key_id),
-            'results': [result.id for result in self.results],
+            'results': [
+                result_id for result_id, in self.results.with_entities(Result.id)
+            ],
         }
 
 
@@ -320,13 +355,25 @@ class Result(Base):
     )
     location = relationship('Location', backref=backref('results', lazy='dynamic'))
 
-    retrieved = Column(DateTime, default=datetime.utcnow, doc='when the test was run')
+    # the Python default also covers databases whose result table was created before the server default existed
+    retrieved = Column(
+        DateTime,
+        default=datetime.utcnow,
+        server_default=func.now(),
+        doc='when the test was run',
+    )
 
     ping = Column(Boolean, nullable=False, doc='did the server respond to a ping?')
     ocsp = Column(
         Boolean, nullable=False, doc='did a valid OCSP request get a good response?'
     )
 
+    __table_args__ = (
+        Index(
+            'ix_result_location_id_chain_id_retrieved', location_id, chain_id, retrieved
+        ),
+    )
+
     @property
     def status(self) -> OCSPResponderStatus:  # relates to the glyphicon displayed
         """Get the status of the responder.
@@ -349,12 +396,7 @@ class Result(Base):
         return {
             'id': self.id,
             'location': {'id': self.location.id, 'location': self.location.name},
-            'chain': {
-                'id': self.chain.id,
-                'retrieved': str(self.chain.retrieved),
-                'expired': self.chain.expired,
-                'old': self.chain.old,
-            },
+            'chain': self.chain.to_json(),
             'retrieved': str(self.retrieved),
             'ping': self.ping,
             'ocsp': self.ocsp,
@@ -5,7 +5,7 @@ r"""OCSPscrape.
 Description:
     ocspscrape update:
         Gets a list of responders to scrape from the OCSPdash, scrapes
-        them, then uploads the results.
+        them, and uploads the results in batches as they are ready.
 
     ocspscrape genkey:
         Generates an EC key pair for signing submissions and registers
@@ -25,33 +25,45 @@ Examples:
 
 """
 
-import json
 import os
 import platform
+import socket
+import struct
 import subprocess
 import sys
+import threading
+import time
 import urllib.parse
 import uuid
-from base64 import urlsafe_b64decode as b64decode, urlsafe_b64encode as b64encode
-from datetime import datetime
-from functools import partial
-from typing import Iterable, Mapping
+from base64 import (
+    standard_b64encode,
+    urlsafe_b64decode as b64decode,
+    urlsafe_b64encode as b64encode,
+)
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from itertools import count, islice
+from typing import Any, Dict, Iterable, List, Mapping, Tuple
 
 import click
+import orjson
 import requests
-from asn1crypto.ocsp import OCSPResponse
+from cryptography import x509
 from cryptography.hazmat.backends import default_backend
-from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives import hashes, serialization
 from cryptography.hazmat.primitives.asymmetric import ec
-from jose import jwt
-from ocspbuilder import OCSPRequestBuilder  # TODO use cryptography's OCSP capabilities?
-from oscrypto import asymmetric
+from cryptography.hazmat.primitives.asymmetric.utils import decode_dss_signature
+from cryptography.x509 import ocsp
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
+from urllib3.util.retry import Retry
 
 from ocspdash.constants import (
     NAMESPACE_OCSPDASH_KID,
+    OCSPSCRAPE_OCSP_NONCE,
+    OCSPSCRAPE_TIMEOUT,
     OCSPSCRAPE_USER_AGENT,
-    OCSP_JWT_ALGORITHM,
+    OCSP_JWT_ALGORITHMS,
     OCSP_RESULTS_JWT_CLAIM,
 )
 
@@ -60,8 +72,52 @@ MANIFEST_URL = urllib.parse.urljoin(API_URL, 'manifest.jsonl')
 SUBMIT_URL = urllib.parse.urljoin(API_URL, 'submit')
 REGISTER_URL = urllib.parse.urljoin(API_URL, 'register')
 
+#: The format of the time each result was retrieved at
+RESULT_TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+#: The hash algorithm used by each ECDSA JWT algorithm
+JWT_HASH_ALGORITHMS = {
+    'ES256': hashes.SHA256,
+    'ES384': hashes.SHA384,
+    'ES512': hashes.SHA512,
+}
+
+#: The largest OCSP request sent with GET, per RFC 5019
+OCSP_GET_MAX_REQUEST_LENGTH = 255
+
+ICMP_ECHO_REPLY = 0
+ICMP_ECHO_REQUEST = 8
+
+#: The number of responders scraped concurrently
+SCRAPE_WORKERS = 32
+#: The number of results signed and submitted together
+SUBMIT_BATCH_SIZE = 100
+
 requests_session = requests.Session()
 requests_session.headers.update({'User-Agent': OCSPSCRAPE_USER_AGENT})
+# keep a connection per worker, so workers querying responders on the same host (e.g. behind the same CDN) reuse
+# connections instead of opening and discarding them, and keep the pools of as many hosts as there are workers. Failed
+# connections and GETs answered by an overloaded gateway are retried with a short backoff.
+_adapter = HTTPAdapter(
+    pool_connections=SCRAPE_WORKERS,
+    pool_maxsize=SCRAPE_WORKERS,
+    max_retries=Retry(total=2, status_forcelist=[502, 503, 504], backoff_factor=0.2),
+)
+requests_session.mount('http://', _adapter)
+requests_session.mount('https://', _adapter)
+#: The number of pings allowed in flight at once
+ping_semaphore = threading.BoundedSemaphore(16)
+#: The sequence numbers of echo requests, so that concurrent pings can tell their replies apart
+ping_sequence = count()
+
+#: Stop querying a responder host after this many consecutive failed requests...
+RESPONDER_FAILURE_THRESHOLD = 3
+#: ...until this many seconds have passed since the most recent failure
+RESPONDER_FAILURE_WINDOW = 600
+
+#: Maps a responder host to its count of consecutive failed requests and the time of the most recent failure
+responder_failures: Dict[str, Tuple[int, float]] = {}
+responder_failures_lock = threading.Lock()
 
 config_directory = os.path.join(os.path.expanduser('~'), '.config', 'ocspdash')
 if not os.path.exists(config_directory):
@@ -100,7 +156,7 @@ def main():
 @click.option('--no-post', is_flag=True)
 def genkey(invite_token, host, no_post):
     """Generate a new public/private keypair."""
-    private_key = ec.generate_private_key(ec.SECP521R1, default_backend())
+    private_key = ec.generate_private_key(ec.SECP256R1, default_backend())
 
     serialized_private_key = private_key.private_bytes(
         encoding=serialization.Encoding.PEM,
@@ -109,15 +165,10 @@ def genkey(invite_token, host, no_post):
     ).decode('utf-8')
     write_private_key(serialized_private_key)
 
-    public_key = b64encode(
-        private_key.public_key().public_bytes(
-            encoding=serialization.Encoding.PEM,
-            format=serialization.PublicFormat.SubjectPublicKeyInfo,
-        )
-    ).decode('utf-8')
+    public_key = _serialize_public_key(private_key)
 
     payload = {'pk': public_key, 'token': invite_token}
-    token = jwt.encode(payload, private_key, algorithm=OCSP_JWT_ALGORITHM)
+    token = _encode_jwt(payload, private_key)
 
     if no_post:
         click.echo(token)
@@ -141,21 +192,13 @@ def update(host, no_post):
 
     manifest_response = requests_session.get(urllib.parse.urljoin(host, MANIFEST_URL))
 
-    if manifest_response.encoding is None:
-        manifest_response.encoding = 'utf-8'
-
-    queries = (
-        json.loads(line)
-        for line in manifest_response.iter_lines(decode_unicode=True)
-        if line
-    )
-
-    token = scrape(key=private_key, queries=queries)
+    queries = (orjson.loads(line) for line in manifest_response.iter_lines() if line)
 
-    if no_post:
-        click.echo(token)
+    for token in scrape(key=private_key, queries=queries):
+        if no_post:
+            click.echo(token)
+            continue
 
-    else:
         submission_response = requests_session.post(
             urllib.parse.urljoin(host, SUBMIT_URL),
             headers={'Content-Type': 'application/octet-stream'},
@@ -172,59 +215,128 @@ def _build_result(session: requests.Session, query: Mapping) -> Mapping:
     :param query: The data from a responder
     """
     responder_url = query['responder_url']
-    netloc = urllib.parse.urlparse(responder_url).netloc
 
     subject_bytes = b64decode(query['subject_certificate'])
     issuer_bytes = b64decode(query['issuer_certificate'])
 
-    time = datetime.utcnow().strftime('%FT%TZ')
-    ping_result = ping(netloc)
+    retrieved = time.strftime(RESULT_TIME_FORMAT, time.gmtime())
+    ping_result = ping(_get_hostname(responder_url))
     ocsp_result = check_ocsp_response(
         subject_bytes, issuer_bytes, responder_url, session
     )
 
     return {
         'certificate_chain_uuid': query['certificate_chain_uuid'],
-        'time': time,
+        'time': retrieved,
         'ping': ping_result,
         'ocsp': ocsp_result,
     }
 
 
-def scrape(key: str, queries: Iterable[Mapping]) -> str:
+def scrape(key: str, queries: Iterable[Mapping]) -> Iterable[bytes]:
     """Scrape the OCSP responders provided.
 
+    Responders are scraped concurrently, but the results keep the order of the queries. A signed token is yielded for
+    each :data:`SUBMIT_BATCH_SIZE` results as soon as they are ready, so they can be submitted while the scrape goes on.
+
     :param key: The private key
     :param queries: An iterator over JSON dictionaries representing the manifest from OCSPdash
     """
     build_result = partial(_build_result, requests_session)
+    private_key = _load_private_key(key)
+    key_id = str(_keyid_from_private_key(key))
 
-    claims = {
-        'iat': datetime.utcnow(),
-        OCSP_RESULTS_JWT_CLAIM: [build_result(query) for query in tqdm(queries)],
-    }
+    with ThreadPoolExecutor(max_workers=SCRAPE_WORKERS) as executor:
+        results = tqdm(executor.map(build_result, queries))
 
-    key_id = str(_keyid_from_private_key(key))
+        for batch in _batched(results, SUBMIT_BATCH_SIZE):
+            claims = {'iat': int(time.time()), OCSP_RESULTS_JWT_CLAIM: batch}
+            yield _encode_jwt(claims, private_key, kid=key_id)
+
+
+def _batched(iterable: Iterable, n: int) -> Iterable[List]:
+    """Split an iterable into lists of n items, the last of which may be shorter.
+
+    :param iterable: The iterable to split
+    :param n: The number of items in each list
+    """
+    iterator = iter(iterable)
+    batch = list(islice(iterator, n))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, n))
+
+
+def _b64encode_jwt_segment(data: bytes) -> bytes:
+    """Encode a segment of a JWT as unpadded URL-safe base64.
+
+    :param data: The bytes of the segment
+    """
+    return b64encode(data).rstrip(b'=')
+
+
+def _encode_jwt(
+    claims: Mapping[str, Any], private_key: ec.EllipticCurvePrivateKey, **headers: str
+) -> bytes:
+    """Encode and sign a JWT with the algorithm in :data:`ocspdash.constants.OCSP_JWT_ALGORITHMS` for the key's curve.
+
+    The claims are serialized with orjson, which is much faster than the standard library for the large results claim.
 
-    return jwt.encode(
-        claims=claims, key=key, headers={'kid': key_id}, algorithm=OCSP_JWT_ALGORITHM
+    :param claims: The claims of the token
+    :param private_key: The private key to sign with
+    :param headers: Additional headers of the token
+    """
+    algorithm = OCSP_JWT_ALGORITHMS[private_key.curve.name]
+    header = {'alg': algorithm, 'typ': 'JWT', **headers}
+    signing_input = b'.'.join(
+        [
+            _b64encode_jwt_segment(orjson.dumps(header)),
+            _b64encode_jwt_segment(orjson.dumps(claims)),
+        ]
     )
 
+    hash_algorithm = JWT_HASH_ALGORITHMS[algorithm]
+    r, s = decode_dss_signature(
+        private_key.sign(signing_input, ec.ECDSA(hash_algorithm()))
+    )
+    # JWS uses the fixed-length concatenation of r and s rather than the DER encoding (RFC 7518, section 3.4)
+    size = (private_key.curve.key_size + 7) // 8
+    signature = r.to_bytes(size, 'big') + s.to_bytes(size, 'big')
 
-def _keyid_from_private_key(private_key_data: str) -> uuid.UUID:
-    """Get a UUID for a private key.
+    return b'.'.join([signing_input, _b64encode_jwt_segment(signature)])
+
+
+@lru_cache(maxsize=4)
+def _load_private_key(private_key_data: str) -> ec.EllipticCurvePrivateKey:
+    """Load a PEM-encoded private key, reusing the result for keys already loaded.
 
     :param private_key_data: The data for a private key
     """
-    loaded_private_key = serialization.load_pem_private_key(
+    return serialization.load_pem_private_key(
         data=private_key_data.encode('utf-8'), password=None, backend=default_backend()
     )
-    public_key = b64encode(
-        loaded_private_key.public_key().public_bytes(
+
+
+def _serialize_public_key(private_key: ec.EllipticCurvePrivateKey) -> str:
+    """Serialize the public key of a private key the way it is registered with the OCSPdash server.
+
+    :param private_key: A private key
+    """
+    return b64encode(
+        private_key.public_key().public_bytes(
             encoding=serialization.Encoding.PEM,
             format=serialization.PublicFormat.SubjectPublicKeyInfo,
         )
     ).decode('utf-8')
+
+
+@lru_cache(maxsize=4)
+def _keyid_from_private_key(private_key_data: str) -> uuid.UUID:
+    """Get a UUID for a private key.
+
+    :param private_key_data: The data for a private key
+    """
+    public_key = _serialize_public_key(_load_private_key(private_key_data))
     key_id = uuid.uuid5(NAMESPACE_OCSPDASH_KID, public_key)
     return key_id
 
@@ -232,20 +344,218 @@ def _keyid_from_private_key(private_key_data: str) -> uuid.UUID:
 def ping(host: str) -> bool:
     """Return if the host responds to a ping request.
 
+    The echo request is sent from an unprivileged ICMP socket where the platform allows one, otherwise the system's
+    ``ping`` command is used. The command is also used for hosts without an IPv4 address.
+
     :param host: The hostname to ping
 
     :returns: True if an ICMP echo is received, False otherwise
     """
+    with ping_semaphore:
+        try:
+            address = socket.gethostbyname(host)
+        except OSError:  # e.g. an IPv6-only host
+            return _ping_subprocess(host)
+
+        try:
+            sock = socket.socket(
+                socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_ICMP
+            )
+        except OSError:  # e.g. Windows, or Linux outside net.ipv4.ping_group_range
+            return _ping_subprocess(host)
+
+        with sock:
+            return _ping_socket(sock, address)
+
+
+def _icmp_checksum(data: bytes) -> int:
+    """Compute the RFC 1071 internet checksum of an ICMP packet.
+
+    :param data: The packet with its checksum field set to zero
+    """
+    if len(data) % 2:
+        data += b'\0'
+    total = sum(struct.unpack(f'!{len(data) // 2}H', data))
+    total = (total >> 16) + (total & 0xFFFF)
+    total += total >> 16
+    return ~total & 0xFFFF
+
+
+def _ping_socket(sock: socket.socket, address: str) -> bool:
+    """Send an ICMP echo request over a datagram socket and wait for the echo reply.
+
+    Not every platform filters the replies delivered to a datagram ICMP socket by its identifier, so replies to other
+    pings running at the same time are skipped by their sender, sequence number and payload.
+
+    :param sock: An ICMP datagram socket
+    :param address: The IPv4 address to ping
+    """
+    sequence = next(ping_sequence) & 0xFFFF
+    payload = b'OCSPscrape' + os.urandom(8)
+    # the kernel fills in the identifier of datagram ICMP sockets
+    header = struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, 0, 0, sequence)
+    checksum = _icmp_checksum(header + payload)
+    packet = (
+        struct.pack('!BBHHH', ICMP_ECHO_REQUEST, 0, checksum, 0, sequence) + payload
+    )
+
+    sock.settimeout(OCSPSCRAPE_TIMEOUT)
+    deadline = time.monotonic() + OCSPSCRAPE_TIMEOUT
+    try:
+        sock.sendto(packet, (address, 0))
+        while True:
+            reply, (sender, *_) = sock.recvfrom(1024)
+            if reply and reply[0] >> 4 == 4:  # some platforms include the IPv4 header
+                header_length = (reply[0] & 0x0F) * 4
+                reply = reply[header_length:]
+            if (
+                sender == address
+                and len(reply) >= 8
+                and reply[0] == ICMP_ECHO_REPLY
+                and struct.unpack('!H', reply[6:8])[0] == sequence
+                and reply[8:] == payload
+            ):
+                return True
+            sock.settimeout(max(deadline - time.monotonic(), 0.001))
+    except OSError:  # includes timeouts
+        return False
+
+
+def _ping_subprocess(host: str) -> bool:
+    """Ping a host with the system's ``ping`` command.
+
+    :param host: The hostname to ping
+    """
     parameters = ['-n', '1'] if platform.system().lower() == 'windows' else ['-c', '1']
-    results = subprocess.run(['ping'] + parameters + [host], stdout=subprocess.DEVNULL)
+    try:
+        results = subprocess.run(
+            ['ping'] + parameters + [host],
+            stdout=subprocess.DEVNULL,
+            timeout=OCSPSCRAPE_TIMEOUT,
+        )
+    except subprocess.TimeoutExpired:
+        return False
     return results.returncode == 0
 
 
+@lru_cache(maxsize=4096)
+def _get_hostname(url: str) -> str:
+    """Get the hostname of a URL, without a port, reusing the result for URLs already seen.
+
+    :param url: A URL
+    """
+    parsed_url = urllib.parse.urlparse(url)
+    return parsed_url.hostname or parsed_url.netloc
+
+
+def _responder_is_failing(host: str) -> bool:
+    """Return if requests to a responder host have recently failed too many times to try again.
+
+    :param host: The hostname of the responder
+    """
+    with responder_failures_lock:
+        failures, last_failure = responder_failures.get(host, (0, 0.0))
+    return (
+        failures >= RESPONDER_FAILURE_THRESHOLD
+        and time.monotonic() - last_failure < RESPONDER_FAILURE_WINDOW
+    )
+
+
+def _record_responder_failure(host: str):
+    """Count a failed request to a responder host.
+
+    :param host: The hostname of the responder
+    """
+    with responder_failures_lock:
+        failures, _ = responder_failures.get(host, (0, 0.0))
+        responder_failures[host] = failures + 1, time.monotonic()
+
+
+def _record_responder_success(host: str):
+    """Reset the count of failed requests to a responder host.
+
+    :param host: The hostname of the responder
+    """
+    with responder_failures_lock:
+        responder_failures.pop(host, None)
+
+
+@lru_cache(maxsize=512)
+def _load_certificate(certificate: bytes) -> x509.Certificate:
+    """Load a DER-encoded certificate, reusing the result for certificates already loaded.
+
+    Issuer certificates in particular recur across the manifest.
+
+    :param certificate: The raw bytes of the certificate
+    """
+    return x509.load_der_x509_certificate(certificate, default_backend())
+
+
+def _encode_ocsp_request(
+    subject: x509.Certificate, issuer: x509.Certificate, nonce: bool
+) -> bytes:
+    """Build a DER-encoded OCSP request.
+
+    :param subject: The certificate that information is being requested about
+    :param issuer: The issuer of the subject certificate
+    :param nonce: Whether to include a random nonce in the request
+    """
+    builder = ocsp.OCSPRequestBuilder().add_certificate(subject, issuer, hashes.SHA1())
+    if nonce:
+        builder = builder.add_extension(x509.OCSPNonce(os.urandom(16)), critical=False)
+    return builder.build().public_bytes(serialization.Encoding.DER)
+
+
+@lru_cache(maxsize=512)
+def _build_ocsp_request(subject_cert: bytes, issuer_cert: bytes) -> bytes:
+    """Build a DER-encoded OCSP request without a nonce, reusing the result for certificates already requested.
+
+    :param subject_cert: The certificate that information is being requested about
+    :param issuer_cert: The issuer of the subject certificate
+    """
+    return _encode_ocsp_request(
+        _load_certificate(subject_cert), _load_certificate(issuer_cert), nonce=False
+    )
+
+
+def _send_ocsp_request(
+    ocsp_request: bytes, url: str, session: requests.Session
+) -> requests.Response:
+    """Send an OCSP request, using GET for small requests so that HTTP caches in front of the responder can answer.
+
+    Requests that are too long for GET, or that a responder rejects when sent with GET, are sent with POST.
+
+    :param ocsp_request: The DER-encoded OCSP request
+    :param url: The URL of the OCSP responder to query
+    :param session: A requests session
+    """
+    if len(ocsp_request) <= OCSP_GET_MAX_REQUEST_LENGTH:
+        encoded_request = urllib.parse.quote(
+            standard_b64encode(ocsp_request).decode('ascii'), safe=''
+        )
+        ocsp_resp = session.get(
+            f'{url.rstrip("/")}/{encoded_request}', timeout=OCSPSCRAPE_TIMEOUT
+        )
+        if not 400 <= ocsp_resp.status_code < 500:
+            return ocsp_resp
+
+    return session.post(
+        url,
+        data=ocsp_request,
+        headers={'Content-Type': 'application/ocsp-request'},
+        timeout=OCSPSCRAPE_TIMEOUT,
+    )
+
+
 def check_ocsp_response(
     subject_cert: bytes, issuer_cert: bytes, url: str, session: requests.Session
 ) -> bool:
     """Create and send an OCSP request.
 
+    Responders whose host has failed :data:`RESPONDER_FAILURE_THRESHOLD` times in a row are not queried again until
+    :data:`RESPONDER_FAILURE_WINDOW` seconds have passed. Requests carry a nonce only if
+    :data:`ocspdash.constants.OCSPSCRAPE_OCSP_NONCE` is set.
+
     :param subject_cert: The certificate that information is being requested about
     :param issuer_cert: The issuer of the subject certificate
     :param url: The URL of the OCSP responder to query
@@ -254,32 +564,37 @@ def check_ocsp_response(
     :returns: True if the request was successful, False otherwise
     """
     try:
-        subject = asymmetric.load_certificate(subject_cert)
-        issuer = asymmetric.load_certificate(issuer_cert)
-    except TypeError:
+        subject = _load_certificate(subject_cert)
+        issuer = _load_certificate(issuer_cert)
+    except ValueError:
+        return False
+
+    host = _get_hostname(url)
+    if _responder_is_failing(host):
         return False
 
-    builder = OCSPRequestBuilder(subject, issuer)
-    ocsp_request = builder.build()
+    if OCSPSCRAPE_OCSP_NONCE:
+        ocsp_request = _encode_ocsp_request(subject, issuer, nonce=True)
+    else:
+        ocsp_request = _build_ocsp_request(subject_cert, issuer_cert)
 
     try:
-        ocsp_resp = session.post(
-            url,
-            data=ocsp_request.dump(),
-            headers={'Content-Type': 'application/ocsp-request'},
-        )
+        ocsp_resp = _send_ocsp_request(ocsp_request, url, session)
     except requests.RequestException:
+        _record_responder_failure(host)
+        return False
+
+    _record_responder_success(host)
+
+    if ocsp_resp.status_code != 200 or not ocsp_resp.content:
         return False
 
     try:
-        parsed_ocsp_response = OCSPResponse.load(ocsp_resp.content)
+        parsed_ocsp_response = ocsp.load_der_ocsp_response(ocsp_resp.content)
     except ValueError:
         return False
 
-    return (
-        parsed_ocsp_response
-        and parsed_ocsp_response.native['response_status'] == 'successful'
-    )
+    return parsed_ocsp_response.response_status == ocsp.OCSPResponseStatus.SUCCESSFUL
 
 
 if __name__ == '__main__':
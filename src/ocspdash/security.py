@@ -1,7 +1,48 @@
 # -*- coding: utf-8 -*-
 
-"""Security-related utilities for OCSPdash. Currently just the CryptContext for passlib."""
+"""Security-related utilities for OCSPdash."""
 
-from passlib.context import CryptContext
+import hashlib
+import hmac
 
-pwd_context = CryptContext(schemes=['argon2'], deprecated='auto')
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHash, VerificationError
+
+__all__ = ['password_hasher', 'hash_validator', 'verify_validator']
+
+#: Verifies invite validators hashed with Argon2 by older versions of OCSPdash
+password_hasher = PasswordHasher()
+
+
+def hash_validator(validator: bytes) -> str:
+    """Hash an invite validator for storage.
+
+    Validators are 16 random bytes, so a fast hash is as hard to reverse as a slow password KDF would be.
+
+    :param validator: The validator to hash
+
+    :returns: The hex-encoded SHA-256 digest of the validator
+    """
+    return hashlib.sha256(validator).hexdigest()
+
+
+def verify_validator(validator: bytes, validator_hash: str) -> bool:
+    """Verify an invite validator against its stored hash in constant time.
+
+    Argon2 hashes created by older versions of OCSPdash are still accepted.
+
+    :param validator: The validator to verify
+    :param validator_hash: The stored hash of the expected validator
+
+    :returns: True if the validator matches the hash, False otherwise
+    """
+    if validator_hash.startswith('$argon2'):
+        try:
+            return password_hasher.verify(validator_hash, validator)
+        except (InvalidHash, VerificationError):
+            return False
+
+    # compared as bytes, since compare_digest raises on a str with non-ASCII characters
+    return hmac.compare_digest(
+        hash_validator(validator).encode('ascii'), validator_hash.encode('utf-8')
+    )
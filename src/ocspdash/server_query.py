@@ -3,32 +3,143 @@
 """Classes for querying Censys.io data on certificates."""
 
 import base64
+import dbm
+import json
 import logging
-from collections import OrderedDict
+import os
+import shelve
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import lru_cache
 from operator import itemgetter
-from typing import MutableMapping, Tuple, Union
+from typing import Dict, Iterable, Mapping, Optional, Set, Tuple, Union
 
 import requests
+from asn1crypto import x509
 
+from ocspdash.constants import CENSYS_REPORT_CACHE_TTL, OCSPDASH_DIRECTORY
 from ocspdash.util import RateLimitedCensysCertificates, requests_session
 
 logger = logging.getLogger(__name__)
 
+#: The connect and read timeouts in seconds for downloading an issuer certificate
+ISSUER_CERT_TIMEOUT = (3, 10)
+
+#: The file in which Censys reports are cached between runs
+CENSYS_REPORT_CACHE_PATH = os.path.join(OCSPDASH_DIRECTORY, 'censys_reports')
+
+
+@lru_cache(maxsize=1024)
+def _load_certificate(certificate: bytes) -> x509.Certificate:
+    """Load a DER-encoded certificate, reusing the result for certificates already loaded.
+
+    asn1crypto parses fields lazily and keeps them on the loaded certificate, so each field is only parsed once.
+
+    :param certificate: The raw bytes of the certificate
+    """
+    return x509.Certificate.load(certificate)
+
+
+_get_doc_count = itemgetter('doc_count')
+
+#: The number of OCSP URLs of an authority retrieved by a report
+OCSP_URL_BUCKETS = 500
+
+#: Censys queries, to be formatted with values escaped by :func:`_quote`
+VALID_QUERY = 'validation.nss.valid: true'
+ISSUER_QUERY = f'{VALID_QUERY} AND parsed.issuer.organization: {{issuer}}'
+CURRENT_ISSUER_QUERY = f'{ISSUER_QUERY} AND tags: "unexpired"'
+CURRENT_URL_QUERY = f'{CURRENT_ISSUER_QUERY} AND parsed.extensions.authority_info_access.ocsp_urls.raw: {{url}}'
+EXAMPLE_CERT_QUERY = f'{ISSUER_QUERY} AND parsed.extensions.authority_info_access.ocsp_urls.raw: {{url}} AND parsed.extensions.authority_info_access.issuer_urls: /.+/'
+CURRENT_EXAMPLE_CERT_QUERY = f'{EXAMPLE_CERT_QUERY} AND tags: "unexpired"'
+
+
+def _quote(value: str) -> str:
+    """Quote a value as a phrase in a Censys query, escaping any quotes or backslashes it contains.
+
+    :param value: The value to quote
+    """
+    escaped_value = value.replace('\\', '\\\\').replace('"', '\\"')
+    return f'"{escaped_value}"'
+
 
 def _get_results(report):
-    return sorted(report['results'], key=itemgetter('doc_count'), reverse=True)
+    return sorted(report['results'], key=_get_doc_count, reverse=True)
 
 
 def _get_results_as_dict(report):
     results = _get_results(report)
 
-    return OrderedDict([(result['key'], result['doc_count']) for result in results])
+    return {result['key']: result['doc_count'] for result in results}
+
+
+def _is_truncated(report, buckets: int) -> bool:
+    """Return if a report left out some of its results because there were more than the number of buckets.
+
+    :param report: A Censys report
+    :param buckets: The number of buckets the report was requested with
+    """
+    return (
+        report.get('metadata', {}).get('other_result_count', 0) > 0
+        or len(report['results']) >= buckets
+    )
 
 
 class ServerQuery(RateLimitedCensysCertificates):
     """An interface to Censys.io's REST API."""
 
-    def get_top_authorities(self, buckets: int = 10) -> MutableMapping[str, int]:
+    def __init__(self, *args, **kwargs) -> None:
+        """Instantiate a ServerQuery. Arguments are passed through to :class:`censys.certificates.CensysCertificates`."""
+        super().__init__(*args, **kwargs)
+        #: Issuer certificates already downloaded, keyed by URL. Responders of one authority typically share these.
+        self._issuer_certs: Dict[str, bytes] = {}
+        #: Serializes downloads of each issuer certificate, so concurrent lookups of the same URL download it once
+        self._issuer_cert_locks: Dict[str, threading.Lock] = {}
+        #: Issuer certificates already known, keyed by their subject key identifier
+        self._issuer_certs_by_key_identifier: Dict[bytes, bytes] = {}
+        self._report_cache_lock = threading.Lock()
+
+    def report(self, *args, **kwargs):
+        """Get a Censys report, reusing reports retrieved in the last :data:`CENSYS_REPORT_CACHE_TTL` seconds.
+
+        Reports are cached on disk, so a scheduled update does not spend rate-limited Censys requests on reports it
+        already retrieved in the previous run. The cache is only open while an entry is read or written, not during
+        the request to Censys, so another process can use it in between. If the cache can't be opened, the report is
+        retrieved without it. Arguments are passed through to :meth:`censys.certificates.CensysCertificates.report`.
+        """
+        if CENSYS_REPORT_CACHE_TTL <= 0:
+            return super().report(*args, **kwargs)
+
+        key = json.dumps([args, kwargs], sort_keys=True)
+
+        try:
+            with self._report_cache_lock, shelve.open(
+                CENSYS_REPORT_CACHE_PATH
+            ) as cache:
+                cached = cache.get(key)
+        except dbm.error:
+            logger.warning('could not read the Censys report cache', exc_info=True)
+            return super().report(*args, **kwargs)
+
+        if cached is not None:
+            retrieved, report = cached
+            if time.time() - retrieved < CENSYS_REPORT_CACHE_TTL:
+                return report
+
+        report = super().report(*args, **kwargs)
+
+        try:
+            with self._report_cache_lock, shelve.open(
+                CENSYS_REPORT_CACHE_PATH
+            ) as cache:
+                cache[key] = time.time(), report
+        except dbm.error:
+            logger.warning('could not write the Censys report cache', exc_info=True)
+
+        return report
+
+    def get_top_authorities(self, buckets: int = 10) -> Dict[str, int]:
         """Retrieve the name and count of certificates for the top n certificate authorities by number of certs.
 
         :param buckets: The number of top authorities to retrieve
@@ -36,14 +147,14 @@ class ServerQuery(RateLimitedCensysCertificates):
         :returns: A mapping of authority name to count of certificates, sorted in descending order by certificate count
         """
         report = self.report(
-            query='validation.nss.valid: true',
+            query=VALID_QUERY,
             field='parsed.issuer.organization',
             buckets=buckets,
         )
 
         return _get_results_as_dict(report)
 
-    def get_ocsp_urls_for_issuer(self, issuer: str) -> MutableMapping[str, int]:
+    def get_ocsp_urls_for_issuer(self, issuer: str) -> Dict[str, int]:
         """Retrieve all the OCSP URLs used by the authority in the wild.
 
         :param issuer: The name of the authority to get OCSP URLs for
@@ -51,36 +162,64 @@ class ServerQuery(RateLimitedCensysCertificates):
         :returns: A mapping of OCSP URLs to count of certificates, sorted in descending order by certificate count
         """
         report = self.report(
-            query=f'validation.nss.valid: true AND parsed.issuer.organization: "{issuer}"',
+            query=ISSUER_QUERY.format(issuer=_quote(issuer)),
             field='parsed.extensions.authority_info_access.ocsp_urls',
+            buckets=OCSP_URL_BUCKETS,
         )
 
         return _get_results_as_dict(report)
 
-    @staticmethod
-    def _url_not_expired(results):
-        return results.get('unexpired', 0) > 0
+    def get_current_ocsp_urls_for_issuer(self, issuer: str) -> Set[str]:
+        """Retrieve the OCSP URLs an authority is currently using.
+
+        A URL is deemed "current" if there is at least one non-expired, valid certificate that lists it. All of an
+        authority's URLs are checked with a single report, which leaves out the least used URLs of an authority with
+        more than :data:`OCSP_URL_BUCKETS` of them.
+
+        :param issuer: The name of the authority
+
+        :returns: The OCSP URLs that appear to be in use
+        """
+        report = self._get_current_ocsp_url_report(issuer)
+
+        return {result['key'] for result in report['results'] if result['doc_count']}
+
+    def _get_current_ocsp_url_report(self, issuer: str):
+        """Get a report counting the non-expired, valid certificates of an authority by OCSP URL.
+
+        :param issuer: The name of the authority
+        """
+        return self.report(
+            query=CURRENT_ISSUER_QUERY.format(issuer=_quote(issuer)),
+            field='parsed.extensions.authority_info_access.ocsp_urls',
+            buckets=OCSP_URL_BUCKETS,
+        )
 
     def is_ocsp_url_current_for_issuer(self, issuer: str, url: str) -> bool:
         """Determine if an issuer is currently using a particular OCSP URL.
 
-        A URL is deemed "current" if there is at least one non-expired, valid certificate that lists it.
+        A URL is deemed "current" if there is at least one non-expired, valid certificate that lists it. Checking
+        several URLs of one authority reuses the cached report of :meth:`get_current_ocsp_urls_for_issuer`. If that
+        report left out some of the authority's URLs, a URL missing from it is checked with a report of its own.
 
         :param issuer: The name of the authority
         :param url: the OCSP URL to check
 
         :returns: True if the URL appears to be in use, False otherwise
         """
-        tags_report = self.report(
-            query=f'validation.nss.valid: true AND parsed.issuer.organization: "{issuer}" AND parsed.extensions.authority_info_access.ocsp_urls.raw: "{url}" AND (tags: "unexpired" OR tags: "expired")',
+        report = self._get_current_ocsp_url_report(issuer)
+        if any(
+            result['key'] == url and result['doc_count'] for result in report['results']
+        ):
+            return True
+        if not _is_truncated(report, OCSP_URL_BUCKETS):
+            return False
+
+        url_report = self.report(
+            query=CURRENT_URL_QUERY.format(issuer=_quote(issuer), url=_quote(url)),
             field='tags',
         )
-
-        results = {
-            result['key']: result['doc_count'] for result in tags_report['results']
-        }
-
-        return self._url_not_expired(results)
+        return _get_results_as_dict(url_report).get('unexpired', 0) > 0
 
     def get_certs_for_issuer_and_url(
         self, issuer: str, url: str
@@ -95,44 +234,143 @@ class ServerQuery(RateLimitedCensysCertificates):
         logger.debug(f'Getting raw certificates for {issuer}: {url}')
 
         logger.debug(f'Getting example cert for {issuer}: {url}')
-        base_query = f'validation.nss.valid: true AND parsed.issuer.organization: "{issuer}" AND parsed.extensions.authority_info_access.ocsp_urls.raw: "{url}" AND parsed.extensions.authority_info_access.issuer_urls: /.+/'
+        query_values = {'issuer': _quote(issuer), 'url': _quote(url)}
+        subject_cert = self._search_first(
+            CURRENT_EXAMPLE_CERT_QUERY.format_map(query_values)
+        )
+        if subject_cert is None:
+            logger.info(f'No valid certificates remain using OCSP URL {url}')
+            logger.info('Searching for an expired certificate instead')
+            subject_cert = self._search_first(EXAMPLE_CERT_QUERY.format_map(query_values))
+            if subject_cert is None:
+                return None, None
+
+        subject_cert_bytes = base64.b64decode(subject_cert['raw'])
+
+        issuer_cert = self._find_issuer_cert(subject_cert_bytes)
+        if issuer_cert is None:
+            logger.debug(f'Getting issuer cert for {issuer}: {url}')
+            issuer_cert = self._get_issuer_cert(
+                subject_cert['parsed.extensions.authority_info_access.issuer_urls']
+            )
+            if issuer_cert is None:
+                return None, None
+            self.add_issuer_certs([issuer_cert])
+
+        return subject_cert_bytes, issuer_cert
+
+    def add_issuer_certs(self, issuer_certs: Iterable[bytes]):
+        """Remember issuer certificates, so the issuer of a subject certificate they issued needn't be downloaded.
+
+        :param issuer_certs: The raw bytes of issuer certificates
+        """
+        for issuer_cert in issuer_certs:
+            try:
+                key_identifier = _load_certificate(issuer_cert).key_identifier
+            except ValueError:
+                continue
+
+            if key_identifier is not None:
+                self._issuer_certs_by_key_identifier[key_identifier] = issuer_cert
+
+    def _find_issuer_cert(self, subject_cert: bytes) -> Optional[bytes]:
+        """Find a known issuer certificate whose key identifier matches the authority key identifier of a subject.
+
+        :param subject_cert: The raw bytes of the subject certificate
+
+        :returns: The raw bytes of the issuer certificate or None if it isn't known
+        """
+        try:
+            key_identifier = _load_certificate(subject_cert).authority_key_identifier
+        except ValueError:
+            return None
+
+        if key_identifier is None:
+            return None
+
+        return self._issuer_certs_by_key_identifier.get(key_identifier)
+
+    def _search_first(self, query: str) -> Optional[Mapping]:
+        """Get the first certificate matching a search, with the fields needed to build a chain.
+
+        Only a single record is requested, so the search never fetches further pages of results.
+
+        :param query: The Censys search query
+
+        :returns: The fields of the first matching certificate or None if there are none
+        """
         search = self.search(
-            query=f'{base_query} AND tags: "unexpired"',
+            query=query,
             fields=[
                 'parsed.extensions.authority_info_access.issuer_urls',
                 'parsed.names',
                 'raw',
             ],
+            max_records=1,
         )
-        subject_cert = next(search, None)
-        if subject_cert is None:
-            logger.info(f'No valid certificates remain using OCSP URL {url}')
-            logger.info('Searching for an expired certificate instead')
-            search = self.search(
-                query=base_query,
-                fields=[
-                    'parsed.extensions.authority_info_access.issuer_urls',
-                    'parsed.names',
-                    'raw',
-                ],
-            )
-            subject_cert = next(search, None)
-            if subject_cert is None:
-                return None, None
+        return next(search, None)
+
+    def _get_issuer_cert(self, issuer_urls: Iterable[str]) -> Optional[bytes]:
+        """Download an issuer certificate from whichever of the URLs first provides one.
+
+        Certificates are only downloaded once per URL, even when several threads look up the same URL at once. When
+        there are several URLs, they are tried concurrently, so a dead mirror doesn't hold up the others.
+
+        :param issuer_urls: The URLs from which the issuer certificate can be downloaded
+
+        :returns: The raw bytes of the issuer certificate or None if unsuccessful
+        """
+        issuer_urls = list(issuer_urls)
 
-        logger.debug(f'Getting issuer cert for {issuer}: {url}')
-        issuer_urls = subject_cert[
-            'parsed.extensions.authority_info_access.issuer_urls'
-        ]
         for issuer_url in issuer_urls:
+            issuer_cert = self._issuer_certs.get(issuer_url)
+            if issuer_cert is not None:
+                return issuer_cert
+
+        if not issuer_urls:
+            return None
+
+        if len(issuer_urls) == 1:
+            return self._download_issuer_cert(issuer_urls[0])
+
+        executor = ThreadPoolExecutor(max_workers=len(issuer_urls))
+        try:
+            futures = [
+                executor.submit(self._download_issuer_cert, issuer_url)
+                for issuer_url in issuer_urls
+            ]
+            for future in as_completed(futures):
+                issuer_cert = future.result()
+                if issuer_cert is not None:
+                    return issuer_cert
+        finally:
+            # don't wait for the slower URLs. their downloads finish in the background and are cached.
+            executor.shutdown(wait=False)
+
+        return None
+
+    def _download_issuer_cert(self, issuer_url: str) -> Optional[bytes]:
+        """Download an issuer certificate from a URL unless it has already been downloaded.
+
+        :param issuer_url: The URL from which the issuer certificate can be downloaded
+
+        :returns: The raw bytes of the issuer certificate or None if unsuccessful
+        """
+        # dict.setdefault is atomic, so every thread gets the same lock for a URL
+        with self._issuer_cert_locks.setdefault(issuer_url, threading.Lock()):
+            issuer_cert = self._issuer_certs.get(issuer_url)
+            if issuer_cert is not None:
+                return issuer_cert
+
             try:
-                resp = requests_session.get(issuer_url)
+                resp = requests_session.get(issuer_url, timeout=ISSUER_CERT_TIMEOUT)
                 resp.raise_for_status()
-                if resp.content:
-                    break
             except requests.RequestException:
                 logger.warning(f'Failed to download issuer cert from {issuer_url}')
-        else:
-            return None, None
+                return None
+
+            if not resp.content:
+                return None
 
-        return base64.b64decode(subject_cert['raw']), resp.content
+            self._issuer_certs[issuer_url] = resp.content
+            return resp.content
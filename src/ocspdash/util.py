@@ -2,18 +2,21 @@
 
 """Miscellaneous utilities for OCSPdash."""
 
-import collections
-import hashlib
 import logging
 import threading
-import time
 import uuid
-from functools import wraps
+from functools import lru_cache, wraps
+from hashlib import sha1
 from json import JSONEncoder
-from typing import Callable, Union
+from time import perf_counter, sleep
+from typing import Callable, Dict, Optional, Union
+from uuid import uuid5 as _stdlib_uuid5
 
 import censys.certificates
+import orjson
 from requests import Session
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from ocspdash.constants import CENSYS_RATE_LIMIT, OCSPDASH_USER_AGENT
 
@@ -21,22 +24,45 @@ logger = logging.getLogger(__name__)
 
 requests_session = Session()
 requests_session.headers.update({'User-Agent': OCSPDASH_USER_AGENT})
+# issuer certificates are mostly hosted by a handful of CA hosts, so keep those connections alive across downloads
+# and ride out their transient failures, including overloaded gateways
+_adapter = HTTPAdapter(
+    pool_connections=32,
+    max_retries=Retry(total=2, backoff_factor=0.3, status_forcelist=[502, 503, 504]),
+)
+requests_session.mount('http://', _adapter)
+requests_session.mount('https://', _adapter)
 
 
 class ToJSONCustomEncoder(JSONEncoder):
-    """A customized JSON encoder that first tries to use the `to_json` attribute to encode an object."""
+    """A customized JSON encoder that first tries to use the `to_json` method to encode an object."""
+
+    #: The `to_json` method of each type encoded so far, or None if the type has none
+    _to_json_methods: Dict[type, Optional[Callable]] = {}
 
     def default(self, obj):  # noqa: 401
-        """Try to use the `to_json` attribute to encode before trying the default."""
-        to_json = getattr(obj, 'to_json', None)
+        """Try to use the `to_json` method to encode before trying the default.
+
+        The method is looked up once per type rather than on every object.
+        """
+        cls = type(obj)
+        try:
+            to_json = self._to_json_methods[cls]
+        except KeyError:
+            to_json = self._to_json_methods[cls] = getattr(cls, 'to_json', None)
+
         if to_json:
-            return to_json()
+            return to_json(obj)
         else:
             return super().default(obj)
 
 
-class OrderedDefaultDict(collections.OrderedDict):
-    """A defaultdict with OrderedDict as its base class."""
+class OrderedDefaultDict(dict):
+    """A defaultdict that remembers insertion order.
+
+    Since Python 3.7 a plain :class:`dict` keeps insertion order, so this builds on it rather than on the slower
+    :class:`collections.OrderedDict`.
+    """
 
     def __init__(self, default_factory: Callable = None, *args, **kwargs) -> None:
         """Create a dict with a default factory that remembers insertion order.
@@ -56,7 +82,7 @@ class OrderedDefaultDict(collections.OrderedDict):
 
     def __reduce__(self):  # for pickle support
         args = (self.default_factory,) if self.default_factory else tuple()
-        return self.__class__, args, None, None, self.items()
+        return self.__class__, args, None, None, iter(self.items())
 
     def __repr__(self):
         return '%s(%r, %r)' % (
@@ -66,50 +92,83 @@ class OrderedDefaultDict(collections.OrderedDict):
         )
 
 
-def uuid5(namespace: uuid.UUID, name: Union[str, bytes]) -> uuid.UUID:
+#: Clears the version and variant bits of a 128-bit integer...
+_UUID_VERSION_VARIANT_MASK = ~((0xF000 << 64) | (0xC000 << 48))
+#: ...so they can be set to version 5 and the RFC 4122 variant
+_UUID5_VERSION_VARIANT = (0x5000 << 64) | (0x8000 << 48)
+
+
+@lru_cache(maxsize=8)
+def _namespace_sha1(namespace: uuid.UUID):
+    """Get a SHA-1 hash object that has already absorbed the namespace, to be copied for each name hashed in it.
+
+    :param namespace: The namespace UUID
+    """
+    return sha1(namespace.bytes)
+
+
+def uuid5(namespace: uuid.UUID, name: Union[str, bytes], *names: bytes) -> uuid.UUID:
     """Generate a UUID from the SHA-1 hash of a namespace UUID and a name.
 
     Unlike the stdlib version, the name can be bytes. If it is a str, this function delgates to the stdlib.
+    A bytes name may be given in several parts, which are hashed as if they were concatenated without actually
+    concatenating them.
 
     :param namespace: The UUID namespace identifier
     :param name: The name, which is a str or bytes
+    :param names: Further parts of a bytes name
 
     :returns: The UUID version 5
     """
     if isinstance(name, str):
-        return uuid.uuid5(namespace, name)
+        return _stdlib_uuid5(namespace, name)
     else:
-        hash = hashlib.sha1(namespace.bytes + name).digest()
-        return uuid.UUID(bytes=hash[:16], version=5)
+        hash = _namespace_sha1(namespace).copy()
+        hash.update(name)
+        for part in names:
+            hash.update(part)
+        value = int.from_bytes(hash.digest()[:16], 'big')
+        return uuid.UUID(
+            int=value & _UUID_VERSION_VARIANT_MASK | _UUID5_VERSION_VARIANT
+        )
 
 
 def rate_limited(max_per_second: Union[int, float]) -> Callable:
-    """Create a decorator to rate-limit a function or method. Only one call will be allowed at a time.
+    """Create a decorator to rate-limit functions or methods with a token bucket.
+
+    All the functions decorated by one decorator share its rate limit. Calls over the limit sleep until their turn
+    without holding up the calls before them, which may run concurrently.
 
     :param max_per_second: The maximum number of calls to the function that will be allowed per second
     """
     lock = threading.Lock()
-    min_interval = 1.0 / max_per_second
+    capacity = max(1.0, max_per_second)
+    interval = 1.0 / max_per_second
+    tokens = capacity
+    last_refill = perf_counter()
 
     def decorate(func: Callable) -> Callable:
         """Decorate the function to rate limit it.
 
         :param func: The function being decorated
         """
-        last_time_called: float = 0.0
 
         @wraps(func)
         def rate_limited_function(*args, **kwargs):
+            nonlocal tokens, last_refill
             with lock:
-                nonlocal last_time_called
-                elapsed = time.perf_counter() - last_time_called
-                left_to_wait = min_interval - elapsed
-                if left_to_wait > 0:
-                    logger.debug('throttling %.2fs', left_to_wait)
-                    time.sleep(left_to_wait)
+                now = perf_counter()
+                tokens = min(capacity, tokens + (now - last_refill) * max_per_second)
+                last_refill = now
+                # take a token, going into debt if there are none left so later calls queue up behind this one
+                tokens -= 1
+                left_to_wait = -tokens * interval
+
+            if left_to_wait > 0:
+                logger.debug('throttling %.2fs', left_to_wait)
+                sleep(left_to_wait)
 
-                last_time_called = time.perf_counter()
-                return func(*args, **kwargs)
+            return func(*args, **kwargs)
 
         return rate_limited_function
 
@@ -119,15 +178,33 @@ def rate_limited(max_per_second: Union[int, float]) -> Callable:
 censys_rate_limit = rate_limited(CENSYS_RATE_LIMIT)
 
 
+def _parse_json_with_orjson(response, *args, **kwargs):
+    """Make :meth:`requests.Response.json` parse the body of a response with orjson.
+
+    :param response: The response, as passed to a requests response hook
+    """
+    response.json = lambda **_: orjson.loads(response.content)
+    return response
+
+
 class RateLimitedCensysCertificates(censys.certificates.CensysCertificates):
-    """A :class:`censys.certificates.CensysCertificates` subclass with the :meth:`search` and :meth:`report` methods rate-limited to :data:`CENSYS_RATE_LIMIT` calls/sec."""
+    """A :class:`censys.certificates.CensysCertificates` subclass with its API requests rate-limited to :data:`CENSYS_RATE_LIMIT` requests/sec."""
 
-    @censys_rate_limit
-    def search(self, *args, **kwargs):
-        """Call the superclass' search method while remaining under the global rate limit."""
-        return super().search(*args, **kwargs)
+    def __init__(self, *args, **kwargs) -> None:
+        """Instantiate the API. Arguments are passed through to :class:`censys.certificates.CensysCertificates`.
+
+        Responses from Censys are parsed with orjson, which is much faster than the standard library for the large
+        pages of search results.
+        """
+        super().__init__(*args, **kwargs)
+        self._session.hooks['response'].append(_parse_json_with_orjson)
 
     @censys_rate_limit
-    def report(self, *args, **kwargs):
-        """Call the superclass' report method while remaining under the global rate limit."""
-        return super().report(*args, **kwargs)
+    def _make_call(self, *args, **kwargs):
+        """Make a request to the Censys API while remaining under the global rate limit.
+
+        Every API request goes through here, including each page of results that :meth:`search` lazily fetches, so
+        the rate limit applies per request rather than per call to :meth:`search` or :meth:`report`. This overrides a
+        private method of censys, so the censys version is pinned.
+        """
+        return super()._make_call(*args, **kwargs)
@@ -11,18 +11,22 @@ from ocspdash.models import Authority, Chain, Location, Responder, Result
 __all__ = ['make_admin']
 
 
+class ChainView(ModelView):
+    """A view for chains that hides the raw certificate columns."""
+
+    column_exclude_list = ('subject', 'issuer')
+
+
 def make_admin(app: Flask, session) -> Admin:
     """Add admin views to the app."""
     admin = Admin(app)
 
-    admin.add_view(ModelView(Authority, session))
-    admin.add_view(ModelView(Responder, session))
-
-    class ChainView(ModelView):
-        column_exclude_list = ['subject', 'issuer']
-
-    admin.add_view(ChainView(Chain, session))
-    admin.add_view(ModelView(Location, session))
-    admin.add_view(ModelView(Result, session))
+    admin.add_views(
+        ModelView(Authority, session),
+        ModelView(Responder, session),
+        ChainView(Chain, session),
+        ModelView(Location, session),
+        ModelView(Result, session),
+    )
 
     return admin
@@ -6,13 +6,12 @@ import logging
 import os
 from typing import Optional
 
-from flasgger import Swagger
 from flask import Flask
 from flask_bootstrap import Bootstrap
+from sqlalchemy.engine.url import make_url
 
 from ocspdash.constants import OCSPDASH_API_VERSION, OCSPDASH_CONNECTION
 from ocspdash.util import ToJSONCustomEncoder
-from ocspdash.web.admin import make_admin
 from ocspdash.web.blueprints import api, ui
 from ocspdash.web.extension import OCSPSQLAlchemy
 
@@ -29,10 +28,19 @@ def create_application(
     :param connection: Database connection string
     :param flask_debug: Enable Flask debug mode, overridden by env $DEBUG
     """
+    connection = connection or OCSPDASH_CONNECTION
+
+    # drop connections the database server has closed before a request uses them
+    engine_options = dict(pool_pre_ping=True)
+    if make_url(connection).get_backend_name() != 'sqlite':
+        # SQLite doesn't pool file connections, but a server can serve a few concurrent requests
+        engine_options.update(pool_size=10, max_overflow=20)
+
     app = Flask(__name__)
     app.config.update(
         dict(
-            SQLALCHEMY_DATABASE_URI=connection or OCSPDASH_CONNECTION,
+            SQLALCHEMY_DATABASE_URI=connection,
+            SQLALCHEMY_ENGINE_OPTIONS=engine_options,
             SQLALCHEMY_TRACK_MODIFICATIONS=False,
             SECRET_KEY=os.environ.get('SECRET_KEY', 'test key'),
             DEBUG=os.environ.get('DEBUG', flask_debug),
@@ -43,13 +51,18 @@ def create_application(
     db = OCSPSQLAlchemy(app=app)
 
     Bootstrap(app)
-    Swagger(app)  # Adds Swagger UI
 
     app.manager = db.manager
     app.json_encoder = ToJSONCustomEncoder
 
     if app.debug:
+        # Flask-Admin and flasgger are only imported in debug mode so production
+        # workers skip loading them and building their views
+        from flasgger import Swagger
+        from ocspdash.web.admin import make_admin
+
         make_admin(app, db.session)
+        Swagger(app)  # Adds Swagger UI
 
     app.register_blueprint(api, url_prefix=f'/api/{OCSPDASH_API_VERSION}')
     app.register_blueprint(ui)
@@ -2,39 +2,69 @@
 
 """The OCSPdash API blueprint."""
 
-import io
 import logging
 import uuid
 from base64 import urlsafe_b64decode as b64decode
 from datetime import datetime
-from functools import partial
+from functools import lru_cache
 from http import HTTPStatus
 
-import jsonlines
+import orjson
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
 from flask import Blueprint, abort, request
 from jose import jwt
 from jose.exceptions import JWTError
 
-from ocspdash.constants import OCSP_JWT_ALGORITHM, OCSP_RESULTS_JWT_CLAIM
+from ocspdash.constants import OCSP_JWT_ALGORITHMS, OCSP_RESULTS_JWT_CLAIM
 from ocspdash.web.proxies import manager
 
-jwt.decode = partial(jwt.decode, algorithms=OCSP_JWT_ALGORITHM)
-
 logger = logging.getLogger(__name__)
 
 api = Blueprint('api', __name__)
 
 
+def _decode_unverified_segment(token: bytes, index: int) -> dict:
+    """Decode one JSON segment of a JWT without verifying its signature.
+
+    This avoids a round trip through jose when only the header or claims are needed to find the verifying key.
+
+    :param token: The compact serialization of the JWT
+    :param index: 0 for the header or 1 for the claims
+    """
+    segment = token.split(b'.', 2)[index]
+    return orjson.loads(b64decode(segment + b'=' * (-len(segment) % 4)))
+
+
+@lru_cache(maxsize=128)
+def _get_jwt_algorithm(public_key: bytes) -> str:
+    """Get the JWT algorithm for tokens signed by the private half of a PEM-encoded public key.
+
+    :param public_key: The PEM-encoded public key
+
+    :raises ValueError: if the key can't be loaded or isn't on an accepted curve
+    """
+    loaded_public_key = serialization.load_pem_public_key(public_key, default_backend())
+    curve = getattr(loaded_public_key, 'curve', None)
+    if curve is None or curve.name not in OCSP_JWT_ALGORITHMS:
+        raise ValueError('Key type not in accepted algorithms')
+    return OCSP_JWT_ALGORITHMS[curve.name]
+
+
 @api.route('/register', methods=['POST'])
 def register_location_key():
     """Register a public key for an invited location."""
     # TODO: error handling (what if no invite, what if duplicate name, etc.)
-    unverified_claims = jwt.get_unverified_claims(request.data)
-    unverified_public_key = b64decode(unverified_claims['pk']).decode('utf-8')
+    unverified_claims = _decode_unverified_segment(request.data, 1)
+    unverified_public_key = b64decode(unverified_claims['pk'])
 
     try:
-        claims = jwt.decode(request.data, unverified_public_key)
-    except JWTError:
+        claims = jwt.decode(
+            request.data,
+            unverified_public_key.decode('utf-8'),
+            algorithms=_get_jwt_algorithm(unverified_public_key),
+        )
+    except (JWTError, ValueError):
         return abort(400)  # bad input
 
     public_key = claims['pk']
@@ -68,15 +98,9 @@ def get_manifest():
     )
     if n > 10:
         abort(400, 'n too large, max is 10')  # TODO get the max config value here too
-    manifest_lines = io.StringIO()
-    with jsonlines.Writer(manifest_lines, sort_keys=True) as writer:
-        writer.write_all(
-            chain.get_manifest_json()
-            for chain in manager.get_most_recent_chains_for_authorities(n)
-        )
 
     return (
-        manifest_lines.getvalue(),
+        manager.get_manifest(n),
         {
             'Content-Type': 'application/json',
             'Content-Disposition': 'inline; filename="manifest.jsonl"',
@@ -84,14 +108,11 @@ def get_manifest():
     )
 
 
-def _prepare_result_dictionary(result_data):
-    certificate_chain_uuid: uuid.UUID = uuid.UUID(result_data['certificate_chain_uuid'])
-    chain = manager.get_chain_by_certificate_chain_uuid(certificate_chain_uuid)
-
+def _prepare_result_dictionary(result_data, chain_id):
     retrieved = datetime.strptime(result_data['time'], '%Y-%m-%dT%H:%M:%SZ')
 
     return {
-        'chain': chain,
+        'chain_id': chain_id,
         'retrieved': retrieved,
         'ping': result_data['ping'],
         'ocsp': result_data['ocsp'],
@@ -106,19 +127,32 @@ def submit():
     tags:
         - ocsp
     """
-    submitted_token_header = jwt.get_unverified_header(request.data)
+    submitted_token_header = _decode_unverified_segment(request.data, 0)
 
     key_id = uuid.UUID(submitted_token_header['kid'])
     submitting_location = manager.get_location_by_key_id(key_id)
 
     try:
-        claims = jwt.decode(request.data, submitting_location.pubkey.decode('utf-8'))
-    except JWTError:
+        claims = jwt.decode(
+            request.data,
+            submitting_location.pubkey.decode('utf-8'),
+            algorithms=_get_jwt_algorithm(submitting_location.pubkey),
+        )
+    except (JWTError, ValueError):
         return abort(400)
 
+    results = claims[OCSP_RESULTS_JWT_CLAIM]
+    certificate_chain_uuids = [
+        uuid.UUID(result_data['certificate_chain_uuid']) for result_data in results
+    ]
+    # look up the chains for the whole submission at once instead of one query per result
+    chain_ids = manager.get_chain_ids_by_certificate_chain_uuids(
+        certificate_chain_uuids
+    )
+
     prepared_result_dicts = (
-        _prepare_result_dictionary(result_data)
-        for result_data in claims[OCSP_RESULTS_JWT_CLAIM]
+        _prepare_result_dictionary(result_data, chain_ids.get(certificate_chain_uuid))
+        for result_data, certificate_chain_uuid in zip(results, certificate_chain_uuids)
     )
     manager.insert_payload(submitting_location, prepared_result_dicts)
 
@@ -9,6 +9,8 @@ __all__ = [
     'TEST_LOCATION_NAME',
     'TEST_PUBLIC_KEY',
     'TEST_KEY_ID',
+    'TEST_P256_PUBLIC_KEY',
+    'TEST_P256_KEY_ID',
     'TEST_BAD_CERTIFICATE_CHAIN_UUID',
     'TEST_CONNECTION',
 ]
@@ -16,6 +18,8 @@ __all__ = [
 TEST_LOCATION_NAME = 'Test Location'
 TEST_PUBLIC_KEY = 'LS0tLS1CRUdJTiBQVUJMSUMgS0VZLS0tLS0KTUlHYk1CQUdCeXFHU000OUFnRUdCU3VCQkFBakE0R0dBQVFCc0orTXJLWU1OdlVPQXZnMThwd0hRTTRnMGRqbQpvaUx5WmFxeTdnQ3ZiT0FZOFo5NmxXSVV4K2NCaVJpZkJrTzlZY2M5UHBHbzA5U2E5Rlo4Z0FZTjluZ0JHR1BTCktsWjlJZUJMZWpQVlBMRk9rMmkwekxwbnVFQ1d2aFhuUE9RazFPSlo4blFOQnN2RWFndXgyRlZIQytJaFlkVVUKbFBJMU8rRzVmTHZ5ZnVnNTBBND0KLS0tLS1FTkQgUFVCTElDIEtFWS0tLS0tCg=='
 TEST_KEY_ID = uuid.UUID('b4896be5-6e0b-57a6-8d6a-b4f1e11f9829')
+TEST_P256_PUBLIC_KEY = 'LS0tLS1CRUdJTiBQVUJMSUMgS0VZLS0tLS0KTUZrd0V3WUhLb1pJemowQ0FRWUlLb1pJemowREFRY0RRZ0FFcTMvaUxoSURvdGpwcm1adnVia1YwbkFQRzlnaQpYMFdOejJ4YzNoVElpZ0xVaVRtSHF4ZHpSVjlBNVp0b1JPUXJMbjJNSVV6czJjNTVGTm1CVnJXQi9nPT0KLS0tLS1FTkQgUFVCTElDIEtFWS0tLS0tCg=='
+TEST_P256_KEY_ID = uuid.UUID('dd630dc1-4fbc-50f3-afda-693fc1b75ce2')
 # From uuid.uuid5(NAMESPACE_OCSPDASH_CERTIFICATE_CHAIN_ID, 'bad certificate chain id'):
 TEST_BAD_CERTIFICATE_CHAIN_UUID = uuid.UUID('3d4f8034-561f-5775-93ab-ca34a0915f90')
 TEST_CONNECTION = os.environ.get('OCSPDASH_TEST_CONNECTION')
@@ -2,14 +2,28 @@
 
 """Test the functionality of the Manager."""
 
+import uuid
 from datetime import datetime
 
+import pytest
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509.oid import NameOID
+from sqlalchemy import create_engine, inspect
+from sqlalchemy.orm import scoped_session, sessionmaker
+
+import ocspdash.manager
 from ocspdash.manager import Manager
 from ocspdash.models import Chain, Result
 from .constants import (
     TEST_BAD_CERTIFICATE_CHAIN_UUID,
     TEST_KEY_ID,
     TEST_LOCATION_NAME,
+    TEST_P256_KEY_ID,
+    TEST_P256_PUBLIC_KEY,
     TEST_PUBLIC_KEY,
 )
 
@@ -85,6 +99,24 @@ def test_ensure_authority(manager_function: Manager):
     assert authority2.cardinality == 2345
 
 
+def test_ensure_authorities(manager_function: Manager):
+    """Test the creation and update of several Authority objects at once."""
+    authority1 = manager_function.ensure_authority(
+        name='Test Authority 1', cardinality=1234
+    )
+
+    authorities = manager_function.ensure_authorities(
+        {'Test Authority 2': 3456, 'Test Authority 1': 2345}
+    )
+
+    assert 2 == len(authorities)
+    assert authorities[0].name == 'Test Authority 2'
+    assert authorities[0].cardinality == 3456
+    assert authorities[1] is authority1
+    assert authority1.cardinality == 2345
+    assert 2 == manager_function.count_authorities()
+
+
 def test_get_responder(manager_function: Manager):
     """Test getting a responder for an Authority and URL."""
     authority = manager_function.ensure_authority(
@@ -149,6 +181,34 @@ def test_get_chain_by_certificate_chain_uuid(manager_function: Manager):
     )
 
 
+def test_get_chain_ids_by_certificate_chain_uuids(manager_function: Manager):
+    """Test retrieving the ids of several Chains by their certificate chain UUIDs."""
+    authority = manager_function.ensure_authority(
+        name='Test Authority', cardinality=1234
+    )
+    responder = manager_function.ensure_responder(
+        authority=authority, url='http://test-responder.url/', cardinality=234
+    )
+    chain1 = Chain(responder=responder, subject=b'cs1', issuer=b'ci')
+    chain2 = Chain(responder=responder, subject=b'cs2', issuer=b'ci')
+    manager_function.session.add_all([chain1, chain2])
+    manager_function.session.commit()
+
+    chain_ids = manager_function.get_chain_ids_by_certificate_chain_uuids(
+        [
+            chain1.certificate_chain_uuid,
+            chain2.certificate_chain_uuid,
+            TEST_BAD_CERTIFICATE_CHAIN_UUID,
+        ]
+    )
+
+    assert chain_ids == {
+        chain1.certificate_chain_uuid: chain1.id,
+        chain2.certificate_chain_uuid: chain2.id,
+    }
+    assert manager_function.get_chain_ids_by_certificate_chain_uuids([]) == {}
+
+
 def test_get_most_recent_chain_by_responder(manager_function: Manager):
     """Test that we get the proper Chain for a Responder."""
     authority = manager_function.ensure_authority(
@@ -199,8 +259,12 @@ def test_get_location_by_name(manager_function: Manager):
     assert manager_function.get_location_by_name('Nonexistent Location') is None
 
 
-def test_location_invites(manager_function: Manager):
-    """Test the invite functionality of Location objects."""
+@pytest.mark.parametrize(
+    'public_key, key_id',
+    [(TEST_PUBLIC_KEY, TEST_KEY_ID), (TEST_P256_PUBLIC_KEY, TEST_P256_KEY_ID)],
+)
+def test_location_invites(manager_function: Manager, public_key, key_id):
+    """Test the invite functionality of Location objects with P-521 and P-256 keys."""
     selector, validator = manager_function.create_location(TEST_LOCATION_NAME)
 
     location = manager_function.get_location_by_selector(selector)
@@ -212,12 +276,12 @@ def test_location_invites(manager_function: Manager):
     assert location.key_id is None
 
     processed_location = manager_function.process_location(
-        b''.join((selector, validator)), TEST_PUBLIC_KEY
+        b''.join((selector, validator)), public_key
     )
     assert location is processed_location
     assert isinstance(processed_location.b64encoded_pubkey, str)
-    assert processed_location.b64encoded_pubkey == TEST_PUBLIC_KEY
-    assert processed_location.key_id == TEST_KEY_ID
+    assert processed_location.b64encoded_pubkey == public_key
+    assert processed_location.key_id == key_id
 
 
 def test_get_all_locations(manager_function: Manager):
@@ -299,11 +363,259 @@ def test_get_most_recent_chains_for_authorities(manager_function: Manager):
     assert c4 in chains
 
 
+def test_get_manifest(manager_function: Manager):
+    """Test that the manifest has a line per chain and is served from the cache while it is fresh."""
+    a1 = manager_function.ensure_authority('a1', 5)
+    r1 = manager_function.ensure_responder(a1, 'url1', 5)
+    r2 = manager_function.ensure_responder(a1, 'url2', 5)
+    c1 = Chain(responder=r1, subject=b'c1s', issuer=b'c1i')
+    manager_function.session.add(c1)
+    manager_function.session.commit()
+
+    manifest = manager_function.get_manifest()
+    assert 1 == len(manifest.splitlines())
+    assert str(c1.certificate_chain_uuid).encode('utf-8') in manifest
+
+    c2 = Chain(responder=r2, subject=b'c2s', issuer=b'c2i')
+    manager_function.session.add(c2)
+    manager_function.session.commit()
+
+    assert manager_function.get_manifest() is manifest
+
+
+def test_add_known_issuer_certs(manager_function: Manager, monkeypatch):
+    """Test that issuer certificates are read once from each chain in the database."""
+    added_issuer_certs = []
+
+    class MockServerQuery:
+        """Records the issuer certificates it is given."""
+
+        def add_issuer_certs(self, issuer_certs):
+            """Record a batch of issuer certificates."""
+            added_issuer_certs.append(sorted(issuer_certs))
+
+    monkeypatch.setattr(manager_function, 'server_query', MockServerQuery())
+    monkeypatch.setattr(manager_function, '_issuer_certs_added_through_chain_id', 0)
+
+    a1 = manager_function.ensure_authority('a1', 5)
+    r1 = manager_function.ensure_responder(a1, 'url1', 5)
+    manager_function.session.add_all(
+        [
+            Chain(responder=r1, subject=b'c1s', issuer=b'ci1'),
+            Chain(responder=r1, subject=b'c2s', issuer=b'ci1'),
+        ]
+    )
+    manager_function.session.commit()
+
+    manager_function._add_known_issuer_certs()
+    manager_function._add_known_issuer_certs()
+    assert added_issuer_certs == [[b'ci1']]
+
+    manager_function.session.add(Chain(responder=r1, subject=b'c3s', issuer=b'ci2'))
+    manager_function.session.commit()
+
+    manager_function._add_known_issuer_certs()
+    assert added_issuer_certs == [[b'ci1'], [b'ci2']]
+
+
+def test_get_manifest_stale(tmp_path, monkeypatch):
+    """Test that a stale manifest is served while it is rebuilt in the background, and kept if that fails."""
+    monkeypatch.setattr(ocspdash.manager, 'OCSPDASH_MANIFEST_CACHE_TTL', 0)
+
+    # the background rebuild needs its own connection, so this uses a database of its own
+    engine = create_engine(f'sqlite:///{tmp_path / "ocspdash.db"}')
+    manager = Manager(engine=engine, session=scoped_session(sessionmaker(bind=engine)))
+
+    def wait_for_refresh():
+        manager._manifest_refresher.submit(lambda: None).result()
+
+    a1 = manager.ensure_authority('a1', 5)
+    r1 = manager.ensure_responder(a1, 'url1', 5)
+    r2 = manager.ensure_responder(a1, 'url2', 5)
+    manager.session.add(Chain(responder=r1, subject=b'c1s', issuer=b'c1i'))
+    manager.session.commit()
+
+    manifest = manager.get_manifest()
+    assert 1 == len(manifest.splitlines())
+
+    c2 = Chain(responder=r2, subject=b'c2s', issuer=b'c2i')
+    manager.session.add(c2)
+    manager.session.commit()
+
+    assert manager.get_manifest() is manifest  # stale, but served while the rebuild runs
+    wait_for_refresh()
+    assert not manager._manifest_refreshes
+
+    refreshed_manifest = manager.get_manifest()
+    assert 2 == len(refreshed_manifest.splitlines())
+    assert str(c2.certificate_chain_uuid).encode('utf-8') in refreshed_manifest
+    wait_for_refresh()
+
+    def fail(n):
+        raise RuntimeError('database unavailable')
+
+    monkeypatch.setattr(manager, '_make_manifest', fail)
+
+    stale_manifest = manager.get_manifest()
+    wait_for_refresh()
+    assert not manager._manifest_refreshes
+    assert manager.get_manifest() is stale_manifest
+    wait_for_refresh()
+
+
 def test_recent_results(manager_function: Manager):
     """Test that nothing crashes if you try and get the recent results."""
-    manager_function.get_most_recent_result_for_each_location()
+    list(manager_function.get_most_recent_result_for_each_location())
 
 
 def test_get_payload(manager_function: Manager):
     """Test that nothing crashes if you try and get the payload."""
     manager_function.get_payload()
+
+
+def test_get_payload_new_results(manager_function: Manager):
+    """Test that a cached payload is not returned after new results are submitted."""
+    authority = manager_function.ensure_authority(
+        name='Test Authority', cardinality=1234
+    )
+    responder = manager_function.ensure_responder(
+        authority=authority, url='http://test-responder.url/', cardinality=234
+    )
+    chain = Chain(responder=responder, subject=b'cs', issuer=b'ci')
+    manager_function.session.add(chain)
+
+    manager_function.create_location('l1')
+    manager_function.create_location('l2')
+    l1 = manager_function.get_location_by_name('l1')
+    l2 = manager_function.get_location_by_name('l2')
+
+    result_data = dict(chain_id=chain.id, retrieved=datetime(2018, 7, 1), ping=True)
+    manager_function.insert_payload(l1, [dict(result_data, ocsp=True)])
+
+    payload = manager_function.get_payload()
+    assert payload.locations == [l1]
+    assert manager_function.get_payload() is payload
+
+    manager_function.insert_payload(l2, [dict(result_data, ocsp=False)])
+
+    payload = manager_function.get_payload()
+    assert payload.locations == [l1, l2]
+    assert [
+        result.ocsp for result in payload.authorities[0].responders[0].results
+    ] == [True, False]
+
+
+def test_get_payload_location_added_concurrently(
+    manager_function: Manager, monkeypatch
+):
+    """Test that a result from a location missing from the location query is left out instead of crashing."""
+    authority = manager_function.ensure_authority(
+        name='Test Authority', cardinality=1234
+    )
+    responder = manager_function.ensure_responder(
+        authority=authority, url='http://test-responder.url/', cardinality=234
+    )
+    chain = Chain(responder=responder, subject=b'cs', issuer=b'ci')
+    manager_function.session.add(chain)
+
+    manager_function.create_location('l1')
+    l1 = manager_function.get_location_by_name('l1')
+    manager_function.insert_payload(
+        l1,
+        [dict(chain_id=chain.id, retrieved=datetime(2018, 7, 1), ping=True, ocsp=True)],
+    )
+
+    # as if the result was committed between the location query and the result query
+    monkeypatch.setattr(manager_function, 'get_all_locations_with_test_results', list)
+
+    payload = manager_function.get_payload()
+    assert payload.locations == []
+    assert payload.authorities == []
+
+
+def test_process_location_bad_invite(manager_function: Manager):
+    """Test that invalid invite tokens are rejected."""
+    with pytest.raises(ValueError):
+        manager_function.process_location(b'too short', TEST_PUBLIC_KEY)
+
+    assert manager_function.process_location(bytes(32), TEST_PUBLIC_KEY) is None
+    assert manager_function.process_location(b'\x01' * 32, TEST_PUBLIC_KEY) is None
+
+
+def test_result_retrieved_default(tmp_path):
+    """Test that a result stored without a time is timestamped in a table created before it had a server default."""
+    engine = create_engine(f'sqlite:///{tmp_path / "ocspdash.db"}')
+    engine.execute(
+        'CREATE TABLE result ('
+        'id INTEGER PRIMARY KEY, '
+        'chain_id INTEGER, '
+        'location_id INTEGER NOT NULL, '
+        'retrieved DATETIME, '
+        'ping BOOLEAN NOT NULL, '
+        'ocsp BOOLEAN NOT NULL'
+        ')'
+    )
+
+    manager = Manager(engine=engine, session=scoped_session(sessionmaker(bind=engine)))
+    manager.create_all()
+    manager.upgrade_database()
+
+    manager.create_location('l1')
+    result = Result(location=manager.get_location_by_name('l1'), ping=True, ocsp=True)
+    manager.session.add(result)
+    manager.session.commit()
+
+    assert result.retrieved is not None
+
+
+def _make_certificate(not_after: datetime) -> bytes:
+    """Make a DER-encoded self-signed certificate that expires at the given time."""
+    private_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Test Certificate')])
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(1)
+        .not_valid_before(datetime(2018, 1, 1))
+        .not_valid_after(not_after)
+        .sign(private_key, hashes.SHA256(), default_backend())
+    )
+    return certificate.public_bytes(Encoding.DER)
+
+
+def test_upgrade_database(tmp_path):
+    """Test that a database from before chain.not_after existed is upgraded in place."""
+    not_after = datetime(2030, 1, 1)
+    certificate = _make_certificate(not_after)
+
+    engine = create_engine(f'sqlite:///{tmp_path / "ocspdash.db"}')
+    engine.execute(
+        'CREATE TABLE chain ('
+        'id INTEGER PRIMARY KEY, '
+        'responder_id INTEGER, '
+        'subject BLOB NOT NULL, '
+        'issuer BLOB NOT NULL, '
+        'retrieved DATETIME NOT NULL, '
+        'certificate_chain_uuid BINARY(16) NOT NULL UNIQUE'
+        ')'
+    )
+    for subject in (certificate, b'cs'):
+        engine.execute(
+            'INSERT INTO chain (subject, issuer, retrieved, certificate_chain_uuid) '
+            'VALUES (?, ?, ?, ?)',
+            (subject, b'ci', '2018-01-01 00:00:00.000000', uuid.uuid4().bytes),
+        )
+
+    manager = Manager(engine=engine, session=scoped_session(sessionmaker(bind=engine)))
+    manager.upgrade_database()
+    manager.upgrade_database()  # running it again changes nothing
+
+    index_names = {index['name'] for index in inspect(engine).get_indexes('chain')}
+    assert {'ix_chain_not_after', 'ix_chain_responder_id_retrieved'} <= index_names
+
+    chain1, chain2 = manager.session.query(Chain).order_by(Chain.id)
+    assert chain1.not_after == not_after
+    assert not chain1.expired
+    assert chain2.not_after is None
@@ -0,0 +1,410 @@
+# -*- coding: utf-8 -*-
+
+"""Test the functionality of OCSPscrape."""
+
+import socket
+import struct
+import threading
+from base64 import urlsafe_b64decode
+from datetime import datetime
+from typing import Callable, Dict, List, Mapping, Optional, Tuple, Union
+
+import pytest
+import requests
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.asymmetric.utils import encode_dss_signature
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509 import ocsp
+from cryptography.x509.oid import NameOID
+from jose import jwt
+
+from ocspdash import ocspscrape
+from ocspdash.web.blueprints.api import _get_jwt_algorithm
+
+TEST_ADDRESS = '192.0.2.1'
+TEST_OTHER_ADDRESS = '192.0.2.2'
+
+
+class MockICMPSocket:
+    """A datagram ICMP socket that answers an echo request with the replies made from it."""
+
+    def __init__(self, *make_replies: Callable[[bytes], Tuple[bytes, str]]) -> None:
+        """Build a mock socket.
+
+        :param make_replies: Functions that each make a reply and the address it is from out of the echo request sent
+        """
+        self.make_replies = make_replies
+        self.replies: List[Tuple[bytes, str]] = []
+        self.timeout: Optional[float] = None
+
+    def settimeout(self, timeout: float):
+        """Set the timeout of the socket."""
+        self.timeout = timeout
+
+    def sendto(self, packet: bytes, address: Tuple[str, int]):
+        """Send an echo request, queueing the replies to it."""
+        self.replies = [make_reply(packet) for make_reply in self.make_replies]
+
+    def recvfrom(self, bufsize: int) -> Tuple[bytes, Tuple[str, int]]:
+        """Receive the next reply, timing out once there are none left."""
+        if not self.replies:
+            raise socket.timeout
+        reply, sender = self.replies.pop(0)
+        return reply, (sender, 0)
+
+
+def _echo_reply(
+    sender: str = TEST_ADDRESS,
+    sequence_offset: int = 0,
+    payload: Optional[bytes] = None,
+) -> Callable[[bytes], Tuple[bytes, str]]:
+    """Make a function that answers an echo request with an echo reply.
+
+    :param sender: The address the reply is from
+    :param sequence_offset: How far the sequence number of the reply is from that of the request
+    :param payload: The payload of the reply, if not that of the request
+    """
+
+    def make_reply(packet: bytes) -> Tuple[bytes, str]:
+        _, _, _, identifier, sequence = struct.unpack('!BBHHH', packet[:8])
+        header = struct.pack(
+            '!BBHHH',
+            ocspscrape.ICMP_ECHO_REPLY,
+            0,
+            0,
+            identifier,
+            (sequence + sequence_offset) & 0xFFFF,
+        )
+        return header + (packet[8:] if payload is None else payload), sender
+
+    return make_reply
+
+
+def test_ping_socket():
+    """Test that a ping succeeds on the echo reply to its request."""
+    assert ocspscrape._ping_socket(MockICMPSocket(_echo_reply()), TEST_ADDRESS)
+
+
+def test_ping_socket_ipv4_header():
+    """Test that an IPv4 header in front of the echo reply is skipped."""
+
+    def make_reply(packet):
+        reply, sender = _echo_reply()(packet)
+        return bytes([0x45]) + bytes(19) + reply, sender
+
+    assert ocspscrape._ping_socket(MockICMPSocket(make_reply), TEST_ADDRESS)
+
+
+def test_ping_socket_timeout():
+    """Test that a ping fails when no reply arrives."""
+    assert not ocspscrape._ping_socket(MockICMPSocket(), TEST_ADDRESS)
+
+
+@pytest.mark.parametrize(
+    'reply',
+    [
+        _echo_reply(sender=TEST_OTHER_ADDRESS),
+        _echo_reply(sequence_offset=1),
+        _echo_reply(payload=b'OCSPscrape'),
+        lambda packet: (packet, TEST_ADDRESS),  # the echo request itself, looped back
+        lambda packet: (b'', TEST_ADDRESS),
+    ],
+)
+def test_ping_socket_other_reply(reply):
+    """Test that replies to other pings are skipped rather than counted as success."""
+    assert not ocspscrape._ping_socket(MockICMPSocket(reply), TEST_ADDRESS)
+    assert ocspscrape._ping_socket(MockICMPSocket(reply, _echo_reply()), TEST_ADDRESS)
+
+
+def test_ping_socket_sequence():
+    """Test that each ping sends a different sequence number and payload."""
+    packets = []
+
+    def make_reply(packet):
+        packets.append(packet)
+        return _echo_reply()(packet)
+
+    for _ in range(2):
+        ocspscrape._ping_socket(MockICMPSocket(make_reply), TEST_ADDRESS)
+
+    assert packets[0][6:8] != packets[1][6:8]
+    assert packets[0][8:] != packets[1][8:]
+    for packet in packets:
+        assert ocspscrape.ICMP_ECHO_REQUEST == packet[0]
+        assert 0 == ocspscrape._icmp_checksum(packet)
+
+
+@pytest.mark.parametrize(
+    'curve, algorithm, signature_length',
+    [(ec.SECP256R1, 'ES256', 64), (ec.SECP521R1, 'ES512', 132)],
+)
+def test_encode_jwt(curve, algorithm, signature_length):
+    """Test that a signed JWT verifies the way the server verifies submissions."""
+    private_key = ec.generate_private_key(curve(), default_backend())
+    public_key = private_key.public_key().public_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PublicFormat.SubjectPublicKeyInfo,
+    )
+    claims = {'pk': 'public key', 'results': [['uuid', True, False, '2018']]}
+
+    token = ocspscrape._encode_jwt(claims, private_key, kid='key id')
+
+    assert algorithm == _get_jwt_algorithm(public_key)
+    assert claims == jwt.decode(
+        token.decode('utf-8'),
+        public_key.decode('utf-8'),
+        algorithms=_get_jwt_algorithm(public_key),
+    )
+    header = jwt.get_unverified_header(token.decode('utf-8'))
+    assert {'alg': algorithm, 'typ': 'JWT', 'kid': 'key id'} == header
+
+    segments = token.split(b'.')
+    assert 3 == len(segments)
+    assert b'=' not in token
+
+    # the signature is the fixed-length concatenation of r and s (RFC 7518, section 3.4)
+    signature = urlsafe_b64decode(segments[2] + b'=' * (-len(segments[2]) % 4))
+    assert signature_length == len(signature)
+    size = signature_length // 2
+    der_signature = encode_dss_signature(
+        int.from_bytes(signature[:size], 'big'), int.from_bytes(signature[size:], 'big')
+    )
+    private_key.public_key().verify(
+        der_signature,
+        b'.'.join(segments[:2]),
+        ec.ECDSA(ocspscrape.JWT_HASH_ALGORITHMS[algorithm]()),
+    )
+
+
+class MockResponse:
+    """A response to an HTTP request."""
+
+    def __init__(self, status_code: int, content: bytes = b'') -> None:
+        """Build a mock response.
+
+        :param status_code: The HTTP status code
+        :param content: The body
+        """
+        self.status_code = status_code
+        self.content = content
+
+
+class MockSession:
+    """A requests session that answers each request with the next of its responses."""
+
+    def __init__(self, *responses: Union[MockResponse, Exception]) -> None:
+        """Build a mock session.
+
+        :param responses: The response to each request in turn, or the exception it raises
+        """
+        self.responses = list(responses)
+        #: The method, URL and keyword arguments of each request made
+        self.requests: List[Tuple[str, str, Mapping]] = []
+
+    def _request(self, method: str, url: str, **kwargs) -> MockResponse:
+        """Record a request and answer it."""
+        self.requests.append((method, url, kwargs))
+        response = self.responses.pop(0)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+    def get(self, url: str, **kwargs) -> MockResponse:
+        """Send a GET request."""
+        return self._request('GET', url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> MockResponse:
+        """Send a POST request."""
+        return self._request('POST', url, **kwargs)
+
+
+@pytest.fixture(scope='module')
+def certificate() -> Tuple[x509.Certificate, ec.EllipticCurvePrivateKey]:
+    """Make a self-signed certificate, which serves as both the subject and the issuer of an OCSP request.
+
+    :returns: The certificate and its private key
+    """
+    private_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, 'Test Certificate')])
+    certificate = (
+        x509.CertificateBuilder()
+        .subject_name(name)
+        .issuer_name(name)
+        .public_key(private_key.public_key())
+        .serial_number(1)
+        .not_valid_before(datetime(2018, 1, 1))
+        .not_valid_after(datetime(2030, 1, 1))
+        .sign(private_key, hashes.SHA256(), default_backend())
+    )
+    return certificate, private_key
+
+
+@pytest.fixture
+def responder_failures(monkeypatch) -> Dict:
+    """Start from no failed requests to any responder host.
+
+    :returns: The failure counts of responder hosts
+    """
+    failures: Dict = {}
+    monkeypatch.setattr(ocspscrape, 'responder_failures', failures)
+    return failures
+
+
+def _make_ocsp_response(certificate, private_key) -> bytes:
+    """Make a DER-encoded successful OCSP response saying a certificate is good.
+
+    :param certificate: The certificate, which is its own issuer
+    :param private_key: The private key of the certificate
+    """
+    response = (
+        ocsp.OCSPResponseBuilder()
+        .add_response(
+            cert=certificate,
+            issuer=certificate,
+            algorithm=hashes.SHA1(),
+            cert_status=ocsp.OCSPCertStatus.GOOD,
+            this_update=datetime(2018, 1, 1),
+            next_update=None,
+            revocation_time=None,
+            revocation_reason=None,
+        )
+        .responder_id(ocsp.OCSPResponderEncoding.HASH, certificate)
+        .sign(private_key, hashes.SHA256())
+    )
+    return response.public_bytes(Encoding.DER)
+
+
+def test_send_ocsp_request_get():
+    """Test that a short OCSP request is sent with GET, its base64 encoding appended to the URL."""
+    ocsp_request = b'\xfb\xff request'
+    session = MockSession(MockResponse(200, b'response'))
+
+    response = ocspscrape._send_ocsp_request(ocsp_request, 'http://ocsp.test/', session)
+
+    assert b'response' == response.content
+    assert 1 == len(session.requests)
+    method, url, _ = session.requests[0]
+    assert 'GET' == method
+    assert 'http://ocsp.test/%2B%2F8gcmVxdWVzdA%3D%3D' == url
+
+
+@pytest.mark.parametrize('status_code', [400, 404, 405])
+def test_send_ocsp_request_post_fallback(status_code):
+    """Test that an OCSP request the responder rejects when sent with GET is sent again with POST."""
+    ocsp_request = b'request'
+    session = MockSession(MockResponse(status_code), MockResponse(200, b'response'))
+
+    response = ocspscrape._send_ocsp_request(ocsp_request, 'http://ocsp.test', session)
+
+    assert b'response' == response.content
+    assert ['GET', 'POST'] == [method for method, _, _ in session.requests]
+    _, url, kwargs = session.requests[1]
+    assert 'http://ocsp.test' == url
+    assert ocsp_request == kwargs['data']
+    assert 'application/ocsp-request' == kwargs['headers']['Content-Type']
+
+
+def test_send_ocsp_request_long():
+    """Test that an OCSP request too long for GET is sent with POST."""
+    ocsp_request = bytes(ocspscrape.OCSP_GET_MAX_REQUEST_LENGTH + 1)
+    session = MockSession(MockResponse(200, b'response'))
+
+    ocspscrape._send_ocsp_request(ocsp_request, 'http://ocsp.test', session)
+
+    assert ['POST'] == [method for method, _, _ in session.requests]
+
+
+def test_send_ocsp_request_server_error():
+    """Test that a server error answering a GET is returned rather than retried with POST."""
+    session = MockSession(MockResponse(500))
+
+    response = ocspscrape._send_ocsp_request(b'request', 'http://ocsp.test', session)
+
+    assert 500 == response.status_code
+    assert 1 == len(session.requests)
+
+
+def test_check_ocsp_response(certificate, responder_failures):
+    """Test that a successful OCSP response counts as success."""
+    certificate, private_key = certificate
+    certificate_bytes = certificate.public_bytes(Encoding.DER)
+    session = MockSession(
+        MockResponse(200, _make_ocsp_response(certificate, private_key))
+    )
+
+    assert ocspscrape.check_ocsp_response(
+        certificate_bytes, certificate_bytes, 'http://ocsp.test', session
+    )
+
+
+@pytest.mark.parametrize(
+    'response',
+    [
+        MockResponse(200),
+        MockResponse(500, b'error'),
+        MockResponse(200, b'not an OCSP response'),
+        MockResponse(
+            200,
+            ocsp.OCSPResponseBuilder.build_unsuccessful(
+                ocsp.OCSPResponseStatus.UNAUTHORIZED
+            ).public_bytes(Encoding.DER),
+        ),
+    ],
+)
+def test_check_ocsp_response_failure(certificate, responder_failures, response):
+    """Test that an empty body, an error status, or an unsuccessful or invalid OCSP response count as failure."""
+    certificate_bytes = certificate[0].public_bytes(Encoding.DER)
+    session = MockSession(response)
+
+    assert not ocspscrape.check_ocsp_response(
+        certificate_bytes, certificate_bytes, 'http://ocsp.test', session
+    )
+    assert not responder_failures  # the responder answered, so it isn't failing
+
+
+def test_check_ocsp_response_failing_responder(
+    certificate, responder_failures, monkeypatch
+):
+    """Test that a responder host isn't queried again after too many failed requests in a row."""
+    certificate_bytes = certificate[0].public_bytes(Encoding.DER)
+    threshold = ocspscrape.RESPONDER_FAILURE_THRESHOLD
+    session = MockSession(*[requests.ConnectionError()] * threshold, MockResponse(200))
+
+    def check(url):
+        return ocspscrape.check_ocsp_response(
+            certificate_bytes, certificate_bytes, url, session
+        )
+
+    for _ in range(threshold):
+        assert not check('http://ocsp.test/1')
+    assert threshold == len(session.requests)
+
+    # the host is skipped, whichever of its URLs is checked
+    assert not check('http://ocsp.test:8080/2')
+    assert threshold == len(session.requests)
+
+    # until the window has passed since the most recent failure
+    monkeypatch.setattr(ocspscrape, 'RESPONDER_FAILURE_WINDOW', 0)
+    assert not check('http://ocsp.test/1')
+    assert threshold + 1 == len(session.requests)
+    assert 'ocsp.test' not in responder_failures  # the responder answered
+
+
+def test_responder_failures_concurrent(responder_failures):
+    """Test that failures counted from several threads at once are all counted."""
+
+    def record_failures():
+        for _ in range(1000):
+            ocspscrape._record_responder_failure('ocsp.test')
+
+    threads = [threading.Thread(target=record_failures) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 8000 == responder_failures['ocsp.test'][0]
+    assert ocspscrape._responder_is_failing('ocsp.test')
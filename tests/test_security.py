@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+
+"""Test the security utilities of OCSPdash."""
+
+import os
+
+import pytest
+
+from ocspdash.security import hash_validator, password_hasher, verify_validator
+
+TEST_VALIDATOR = bytes(range(16))
+
+
+def test_validator_round_trip():
+    """Test that a validator verifies against its own hash, and no other validator does."""
+    validator = os.urandom(16)
+    validator_hash = hash_validator(validator)
+
+    assert verify_validator(validator, validator_hash)
+    assert not verify_validator(TEST_VALIDATOR, validator_hash)
+    assert not verify_validator(validator + b'\0', validator_hash)
+
+
+def test_legacy_argon2_validator():
+    """Test that a validator hashed with Argon2 by an older version of OCSPdash still verifies."""
+    validator_hash = password_hasher.hash(TEST_VALIDATOR)
+    assert validator_hash.startswith('$argon2')
+
+    assert verify_validator(TEST_VALIDATOR, validator_hash)
+    assert not verify_validator(os.urandom(16), validator_hash)
+
+
+@pytest.mark.parametrize(
+    'validator_hash',
+    [
+        '',
+        'not a hash',
+        hash_validator(TEST_VALIDATOR)[:-1],
+        hash_validator(TEST_VALIDATOR).upper(),
+        hash_validator(TEST_VALIDATOR) + 'ü',
+        '$argon2id$v=19$m=102400,t=2,p=8$garbage',
+        password_hasher.hash(TEST_VALIDATOR)[:-4],
+    ],
+)
+def test_malformed_validator_hash(validator_hash):
+    """Test that a malformed stored hash is rejected rather than raising."""
+    assert not verify_validator(TEST_VALIDATOR, validator_hash)
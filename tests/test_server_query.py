@@ -0,0 +1,352 @@
+# -*- coding: utf-8 -*-
+
+"""Test the functionality of the ServerQuery."""
+
+import dbm
+import shelve
+import sys
+from datetime import datetime
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import censys.base
+import pytest
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.hazmat.primitives.serialization import Encoding
+from cryptography.x509.oid import NameOID
+
+import ocspdash.server_query
+import ocspdash.util
+from ocspdash.constants import CENSYS_REPORT_CACHE_TTL
+from ocspdash.server_query import (
+    CURRENT_ISSUER_QUERY,
+    CURRENT_URL_QUERY,
+    OCSP_URL_BUCKETS,
+    VALID_QUERY,
+    ServerQuery,
+    _quote,
+)
+from ocspdash.util import RateLimitedCensysCertificates, _parse_json_with_orjson
+
+TEST_ISSUER = 'Test Authority'
+
+
+class MockCensysAPI:
+    """Answers the requests that :class:`censys.base.CensysAPIBase` makes to the Censys API."""
+
+    def __init__(self) -> None:
+        """Build a mock API with no reports."""
+        #: The endpoint and data of each request made
+        self.calls: List[Tuple[str, Optional[Mapping]]] = []
+        #: The report answering each query
+        self.reports: Dict[str, Mapping] = {}
+
+    def __call__(self, method, endpoint: str, args=None, data=None):
+        """Answer a request, standing in for :meth:`censys.base.CensysAPIBase._make_call`."""
+        self.calls.append((endpoint, data))
+        if endpoint.startswith('search/'):
+            return {'results': [], 'metadata': {'pages': 1}}
+        if endpoint.startswith('report/'):
+            return self.reports.get(data['query'], {'results': [], 'metadata': {}})
+        return {}
+
+    def report_calls(self) -> List[Mapping]:
+        """Get the data of each report requested."""
+        return [data for endpoint, data in self.calls if endpoint.startswith('report/')]
+
+
+def _make_report(results: Mapping[str, int], other_result_count: int = 0) -> Mapping:
+    """Build a Censys report.
+
+    :param results: The count for each key of the report
+    :param other_result_count: The count of results left out of the report
+    """
+    return {
+        'results': [{'key': key, 'doc_count': count} for key, count in results.items()],
+        'metadata': {'other_result_count': other_result_count},
+    }
+
+
+@pytest.fixture
+def censys_api(monkeypatch, tmp_path) -> MockCensysAPI:
+    """Replace the Censys API with a mock, and cache its reports in a temporary directory.
+
+    :returns: The mock API
+    """
+    api = MockCensysAPI()
+    monkeypatch.setattr(censys.base.CensysAPIBase, '_make_call', api)
+    monkeypatch.setattr(ocspdash.util, 'sleep', lambda seconds: None)
+    monkeypatch.setattr(
+        ocspdash.server_query,
+        'CENSYS_REPORT_CACHE_PATH',
+        str(tmp_path / 'censys_reports'),
+    )
+    return api
+
+
+@pytest.fixture
+def server_query(censys_api: MockCensysAPI) -> ServerQuery:
+    """Create a ServerQuery that uses the mock Censys API.
+
+    :returns: The ServerQuery
+    """
+    server_query = ServerQuery(api_id='test-id', api_secret='test-secret')
+    censys_api.calls.clear()  # the account lookup on instantiation
+    return server_query
+
+
+def test_is_ocsp_url_current_for_issuer(
+    server_query: ServerQuery, censys_api: MockCensysAPI
+):
+    """Test that all of an authority's OCSP URLs are checked with a single report."""
+    issuer_query = CURRENT_ISSUER_QUERY.format(issuer=_quote(TEST_ISSUER))
+    censys_api.reports[issuer_query] = _make_report(
+        {'http://url1': 5, 'http://url2': 0}
+    )
+
+    assert server_query.is_ocsp_url_current_for_issuer(TEST_ISSUER, 'http://url1')
+    assert not server_query.is_ocsp_url_current_for_issuer(TEST_ISSUER, 'http://url2')
+    assert not server_query.is_ocsp_url_current_for_issuer(TEST_ISSUER, 'http://url3')
+    assert {'http://url1'} == server_query.get_current_ocsp_urls_for_issuer(
+        TEST_ISSUER
+    )
+
+    report_calls = censys_api.report_calls()
+    assert 1 == len(report_calls)
+    assert OCSP_URL_BUCKETS == report_calls[0]['buckets']
+
+
+@pytest.mark.parametrize('tags, expected', [({'unexpired': 1}, True), ({}, False)])
+def test_is_ocsp_url_current_for_issuer_truncated(
+    server_query: ServerQuery, censys_api: MockCensysAPI, tags, expected
+):
+    """Test that a URL left out of a truncated report is checked with a report of its own."""
+    issuer_query = CURRENT_ISSUER_QUERY.format(issuer=_quote(TEST_ISSUER))
+    censys_api.reports[issuer_query] = _make_report(
+        {'http://url1': 5}, other_result_count=1
+    )
+    url_query = CURRENT_URL_QUERY.format(
+        issuer=_quote(TEST_ISSUER), url=_quote('http://url2')
+    )
+    censys_api.reports[url_query] = _make_report(tags)
+
+    assert server_query.is_ocsp_url_current_for_issuer(TEST_ISSUER, 'http://url1')
+    assert 1 == len(censys_api.report_calls())
+
+    assert expected == server_query.is_ocsp_url_current_for_issuer(
+        TEST_ISSUER, 'http://url2'
+    )
+    report_calls = censys_api.report_calls()
+    assert 2 == len(report_calls)
+    assert url_query == report_calls[1]['query']
+    assert 'tags' == report_calls[1]['field']
+
+
+def test_report_cache(
+    server_query: ServerQuery, censys_api: MockCensysAPI, monkeypatch
+):
+    """Test that a cached report is reused until it expires, and that the cache is only open to read or write it."""
+    open_shelves = []
+    shelve_open = shelve.open
+
+    def open_tracked_shelf(*args, **kwargs):
+        shelf = shelve_open(*args, **kwargs)
+        open_shelves.append(shelf)
+        shelf_close = shelf.close
+
+        def close():
+            if shelf in open_shelves:
+                open_shelves.remove(shelf)
+            shelf_close()
+
+        shelf.close = close
+        return shelf
+
+    def answer(api, *args, **kwargs):
+        assert not open_shelves  # the cache is closed while Censys is queried
+        return censys_api(*args, **kwargs)
+
+    now = 1000.0
+    monkeypatch.setattr(shelve, 'open', open_tracked_shelf)
+    monkeypatch.setattr(censys.base.CensysAPIBase, '_make_call', answer)
+    monkeypatch.setattr(ocspdash.server_query.time, 'time', lambda: now)
+
+    report = server_query.get_top_authorities()
+    assert 1 == len(censys_api.report_calls())
+    assert not open_shelves
+
+    assert report == server_query.get_top_authorities()
+    assert 1 == len(censys_api.report_calls())  # a cache hit
+
+    server_query.get_top_authorities(buckets=20)
+    assert 2 == len(censys_api.report_calls())  # a different report isn't a hit
+
+    now += CENSYS_REPORT_CACHE_TTL
+    server_query.get_top_authorities()
+    assert 3 == len(censys_api.report_calls())  # the cached report expired
+
+    server_query.get_top_authorities()
+    assert 3 == len(censys_api.report_calls())  # and was replaced
+    assert not open_shelves
+
+
+def test_report_cache_persists(censys_api: MockCensysAPI):
+    """Test that a cached report is reused by a later run."""
+    ServerQuery(api_id='test-id', api_secret='test-secret').get_top_authorities()
+    ServerQuery(api_id='test-id', api_secret='test-secret').get_top_authorities()
+
+    assert 1 == len(censys_api.report_calls())
+
+
+def test_report_cache_error(
+    server_query: ServerQuery, censys_api: MockCensysAPI, monkeypatch
+):
+    """Test that reports are retrieved without the cache when it can't be opened."""
+
+    def open_broken_shelf(*args, **kwargs):
+        raise dbm.error[0]('cache is corrupt')
+
+    monkeypatch.setattr(shelve, 'open', open_broken_shelf)
+
+    censys_api.reports[VALID_QUERY] = _make_report({'Test Authority': 5})
+    for _ in range(2):
+        assert {'Test Authority': 5} == server_query.get_top_authorities()
+    assert 2 == len(censys_api.report_calls())
+
+
+def test_report_cache_disabled(
+    server_query: ServerQuery, censys_api: MockCensysAPI, monkeypatch
+):
+    """Test that every report is retrieved from Censys when the cache is disabled."""
+    monkeypatch.setattr(ocspdash.server_query, 'CENSYS_REPORT_CACHE_TTL', 0)
+
+    for _ in range(2):
+        server_query.get_top_authorities()
+    assert 2 == len(censys_api.report_calls())
+
+
+def _make_certificate(
+    subject_name: str,
+    private_key: ec.EllipticCurvePrivateKey,
+    issuer_name: str,
+    issuer_key: ec.EllipticCurvePrivateKey,
+    authority_key_identifier: bool = True,
+) -> bytes:
+    """Make a DER-encoded certificate with a subject key identifier.
+
+    :param subject_name: The common name of the subject
+    :param private_key: The private key of the subject
+    :param issuer_name: The common name of the issuer
+    :param issuer_key: The private key of the issuer, which signs the certificate
+    :param authority_key_identifier: Whether to identify the issuer's key in an authority key identifier extension
+    """
+    builder = (
+        x509.CertificateBuilder()
+        .subject_name(
+            x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, subject_name)])
+        )
+        .issuer_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, issuer_name)]))
+        .public_key(private_key.public_key())
+        .serial_number(x509.random_serial_number())
+        .not_valid_before(datetime(2018, 1, 1))
+        .not_valid_after(datetime(2030, 1, 1))
+        .add_extension(
+            x509.SubjectKeyIdentifier.from_public_key(private_key.public_key()),
+            critical=False,
+        )
+    )
+    if authority_key_identifier:
+        builder = builder.add_extension(
+            x509.AuthorityKeyIdentifier.from_issuer_public_key(
+                issuer_key.public_key()
+            ),
+            critical=False,
+        )
+    certificate = builder.sign(issuer_key, hashes.SHA256(), default_backend())
+    return certificate.public_bytes(Encoding.DER)
+
+
+@pytest.fixture(scope='module')
+def issuer_keys() -> Tuple[ec.EllipticCurvePrivateKey, ec.EllipticCurvePrivateKey]:
+    """Make the private keys of two issuers.
+
+    :returns: The private keys
+    """
+    return tuple(
+        ec.generate_private_key(ec.SECP256R1(), default_backend()) for _ in range(2)
+    )
+
+
+def test_find_issuer_cert(server_query: ServerQuery, issuer_keys):
+    """Test that a subject's issuer is found among the known issuers by its key identifier."""
+    issuer_key1, issuer_key2 = issuer_keys
+    subject_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    issuer1 = _make_certificate('Issuer', issuer_key1, 'Issuer', issuer_key1)
+    issuer2 = _make_certificate('Issuer', issuer_key2, 'Issuer', issuer_key2)
+    subject = _make_certificate('Subject', subject_key, 'Issuer', issuer_key2)
+
+    assert server_query._find_issuer_cert(subject) is None
+
+    server_query.add_issuer_certs([issuer1, b'not a certificate'])
+    # the same issuer name, but another key
+    assert server_query._find_issuer_cert(subject) is None
+
+    server_query.add_issuer_certs([issuer2])
+    assert issuer2 == server_query._find_issuer_cert(subject)
+    assert issuer1 == server_query._find_issuer_cert(issuer1)  # self-signed
+
+
+def test_find_issuer_cert_without_authority_key_identifier(
+    server_query: ServerQuery, issuer_keys
+):
+    """Test that the issuer of a subject without an authority key identifier isn't found."""
+    issuer_key, _ = issuer_keys
+    subject_key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+    issuer = _make_certificate('Issuer', issuer_key, 'Issuer', issuer_key)
+    subject = _make_certificate(
+        'Subject', subject_key, 'Issuer', issuer_key, authority_key_identifier=False
+    )
+
+    server_query.add_issuer_certs([issuer])
+
+    assert server_query._find_issuer_cert(subject) is None
+    assert server_query._find_issuer_cert(b'not a certificate') is None
+
+
+def test_rate_limited_calls(
+    server_query: ServerQuery, censys_api: MockCensysAPI, monkeypatch
+):
+    """Test that searches and reports go through the rate-limited override of the private censys method.
+
+    If a new version of censys stops making its requests through ``_make_call``, they aren't rate-limited anymore.
+    """
+    rate_limited_codes = {
+        RateLimitedCensysCertificates._make_call.__code__,
+        RateLimitedCensysCertificates._make_call.__wrapped__.__code__,
+    }
+    rate_limited_calls = []
+
+    def answer(api, *args, **kwargs):
+        frame = sys._getframe()
+        codes = set()
+        while frame is not None:
+            codes.add(frame.f_code)
+            frame = frame.f_back
+        rate_limited_calls.append(rate_limited_codes <= codes)
+        return censys_api(*args, **kwargs)
+
+    monkeypatch.setattr(censys.base.CensysAPIBase, '_make_call', answer)
+    server_query._search_first('query')
+    server_query.get_top_authorities()
+
+    assert ['search/certificates', 'report/certificates'] == [
+        endpoint for endpoint, _ in censys_api.calls
+    ]
+    assert [True, True] == rate_limited_calls
+
+
+def test_orjson_response_hook(server_query: ServerQuery):
+    """Test that responses from Censys are parsed with orjson."""
+    assert _parse_json_with_orjson in server_query._session.hooks['response']
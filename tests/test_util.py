@@ -0,0 +1,172 @@
+# -*- coding: utf-8 -*-
+
+"""Test the utilities of OCSPdash."""
+
+import hashlib
+import threading
+import uuid
+from typing import List
+
+import pytest
+
+import ocspdash.util
+
+from ocspdash.constants import (
+    NAMESPACE_OCSPDASH_CERTIFICATE_CHAIN_ID,
+    NAMESPACE_OCSPDASH_KID,
+)
+from ocspdash.manager import Manager
+from ocspdash.models import Chain
+from ocspdash.util import rate_limited, uuid5
+
+
+def _reference_uuid5(namespace: uuid.UUID, *names: bytes) -> uuid.UUID:
+    """Generate a UUID the way :func:`ocspdash.util.uuid5` did before it reused the hash of each namespace.
+
+    :param namespace: The UUID namespace identifier
+    :param names: The parts of the name
+    """
+    hash = hashlib.sha1(namespace.bytes + b''.join(names))
+    return uuid.UUID(bytes=hash.digest()[:16], version=5)
+
+
+@pytest.mark.parametrize('name', ['', 'public key', 'ünïcode'])
+def test_uuid5_str(name):
+    """Test that a str name gives the same UUID as the stdlib, and the same as its UTF-8 encoding."""
+    expected = uuid.uuid5(NAMESPACE_OCSPDASH_KID, name)
+
+    assert expected == uuid5(NAMESPACE_OCSPDASH_KID, name)
+    assert expected == uuid5(NAMESPACE_OCSPDASH_KID, name.encode('utf-8'))
+
+
+@pytest.mark.parametrize(
+    'names',
+    [
+        (b'',),
+        (b'subject',),
+        (b'subject', b'issuer'),
+        (b'sub', b'ject', b'', b'issuer'),
+        (bytes(range(256)) * 8, b'\xff' * 1000),
+    ],
+)
+@pytest.mark.parametrize(
+    'namespace', [NAMESPACE_OCSPDASH_CERTIFICATE_CHAIN_ID, NAMESPACE_OCSPDASH_KID]
+)
+def test_uuid5_bytes(namespace, names):
+    """Test that a bytes name, in one or several parts, gives the same UUID as before."""
+    result = uuid5(namespace, *names)
+
+    assert _reference_uuid5(namespace, *names) == result
+    assert 5 == result.version
+    assert uuid.RFC_4122 == result.variant
+
+
+def test_certificate_chain_uuid(manager_function: Manager):
+    """Test that the UUID stored for a chain hasn't changed, since scrapers submit their results by it."""
+    chain = Chain(subject=b'subject', issuer=b'issuer')
+    manager_function.session.add(chain)
+    manager_function.session.commit()
+
+    expected = uuid.UUID('191d193c-8d1b-5fce-9189-1f121736ee7d')
+    assert expected == _reference_uuid5(
+        NAMESPACE_OCSPDASH_CERTIFICATE_CHAIN_ID, b'subject', b'issuer'
+    )
+    assert expected == chain.certificate_chain_uuid
+
+
+class MockClock:
+    """A clock that only moves when told to, and records the sleeps that would have waited on it."""
+
+    def __init__(self) -> None:
+        """Build a mock clock at time zero."""
+        self.now = 0.0
+        self.sleeps: List[float] = []
+        self._lock = threading.Lock()
+
+    def perf_counter(self) -> float:
+        """Get the current time."""
+        return self.now
+
+    def sleep(self, seconds: float):
+        """Record a sleep."""
+        with self._lock:
+            self.sleeps.append(seconds)
+
+
+@pytest.fixture
+def clock(monkeypatch) -> MockClock:
+    """Replace the clock used by :func:`ocspdash.util.rate_limited` with a mock.
+
+    :returns: The mock clock
+    """
+    clock = MockClock()
+    monkeypatch.setattr(ocspdash.util, 'perf_counter', clock.perf_counter)
+    monkeypatch.setattr(ocspdash.util, 'sleep', clock.sleep)
+    return clock
+
+
+def test_rate_limited_concurrent(clock: MockClock):
+    """Test that concurrent calls over the limit each wait their turn, spaced out at the configured rate."""
+    calls = []
+    barrier = threading.Barrier(10)
+
+    @rate_limited(2)
+    def call(i):
+        calls.append(i)
+
+    def run(i):
+        barrier.wait()
+        call(i)
+
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(10)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert 10 == len(calls)
+    # the first two calls use up the bucket, then each call waits half a second longer than the one before it
+    assert [0.5 * i for i in range(1, 9)] == pytest.approx(sorted(clock.sleeps))
+    assert 18 == pytest.approx(sum(clock.sleeps))
+
+
+def test_rate_limited_refill(clock: MockClock):
+    """Test that the bucket refills over time, but never beyond its capacity."""
+
+    @rate_limited(2)
+    def call():
+        pass
+
+    for _ in range(4):
+        call()
+    assert [0.5, 1.0] == pytest.approx(clock.sleeps)
+
+    clock.now += 1.5  # long enough to pay off the debt and earn one call
+    call()
+    assert [0.5, 1.0] == pytest.approx(clock.sleeps)
+    call()
+    assert [0.5, 1.0, 0.5] == pytest.approx(clock.sleeps)
+
+    clock.now += 100
+    clock.sleeps.clear()
+    for _ in range(3):
+        call()
+    assert [0.5] == pytest.approx(clock.sleeps)
+
+
+def test_rate_limited_shared(clock: MockClock):
+    """Test that the functions decorated by one decorator share its limit."""
+    limit = rate_limited(1)
+
+    @limit
+    def call1():
+        pass
+
+    @limit
+    def call2():
+        pass
+
+    call1()
+    call2()
+    call1()
+    assert [1.0, 2.0] == pytest.approx(clock.sleeps)